@@ -9,11 +9,11 @@ Here we keep classes and functions for the Pytorch Quantum States library.
 @author: Alex Lidiak
 """
 
-import itertools
+import warnings
 import numpy as np
 import torch
 import torch.nn as nn
-from autograd_hacks_master import autograd_hacks
+import autograd_hacks
 
 class Op:
     
@@ -21,12 +21,134 @@ class Op:
         self.matrix=matrix
         self.sites=[]
         
+        # Sparse table of the nonzero transitions of the operator. Row r of the 
+        # matrix is the input local state and each nonzero column an output 
+        # local state with amplitude matrix[r,c]. Rows with fewer nonzeros are 
+        # padded with transitions back to r with amplitude 0. 
+        matrix=np.asarray(matrix)
+        dim=matrix.shape[0]
+        n_trans=max(np.max(np.sum(matrix!=0,1)),1)
+        self.trans_cols=np.tile(np.arange(dim)[:,None],[1,n_trans])
+        self.trans_amps=np.zeros([dim,n_trans],dtype=matrix.dtype)
+        for r in range(dim):
+            cols=np.nonzero(matrix[r])[0]
+            self.trans_cols[r,:len(cols)]=cols
+            self.trans_amps[r,:len(cols)]=matrix[r,cols]
+        # diagonal operators never change s, so O_local needs no extra forward passes
+        self.diagonal=bool(np.all(self.trans_cols==np.arange(dim)[:,None]))
+        
     def add_site(self,new_site):
         self.sites.append(new_site)
         
-    # Could potentially add the O_loc function here as a method to Op
+        return
+    
+    # Generates the configurations s' connected to each sample of s by a 
+    # nonzero matrix element. Returns the diagonal (s'=s) elements for each 
+    # sample and site, and for the off-diagonal elements the sample index, site 
+    # index, s' and matrix element of each transition. 
+    def connected(self, s, evals):
+        
+        evals=np.asarray(evals)
+        sites=np.array(self.sites)
+        [n_sites,op_span]=sites.shape
+        [N_samples,L]=s.shape
+        dim=len(evals)
+        
+        # local basis index of each spin, ordered opposite to the evals: for 
+        # spin 1/2 the 1 state = (1,0) and -1 state = (0,1) convention.
+        basis_ind=dim-1-np.argmax(s[...,None]==evals,-1)
+        pows=dim**np.arange(op_span-1,-1,-1) # kron ordering, first site slowest
+        
+        diag=np.zeros([N_samples,n_sites],dtype=complex)
+        n_idx, i_idx, s_primes, mels = [], [], [], []
+        for i in range(n_sites):
+            
+            row=basis_ind[:,sites[i]].dot(pows) # input state in extended basis
+            cols, amps = self.trans_cols[row], self.trans_amps[row]
+            same=(cols==row[:,None])
+            diag[:,i]=np.sum(amps*same,1)
+            if self.diagonal: continue
+            
+            nn_, kk = np.nonzero((amps!=0)&(~same))
+            # decompose the output state back into the local spins of each site
+            out_ind=(cols[nn_,kk][:,None]//pows)%dim
+            s_prime=s[nn_].copy()
+            s_prime[:,sites[i]]=evals[dim-1-out_ind]
+            
+            n_idx.append(nn_); i_idx.append(np.full(len(nn_),i))
+            s_primes.append(s_prime); mels.append(amps[nn_,kk])
+        
+        if len(n_idx)==0:
+            return diag, np.zeros(0,dtype=int), np.zeros(0,dtype=int), \
+                np.zeros([0,L]), np.zeros(0,dtype=complex)
+        
+        return diag, np.concatenate(n_idx), np.concatenate(i_idx), \
+            np.concatenate(s_primes), np.concatenate(mels)
+
+'''###################### Hamiltonian ######################################'''
+class Hamiltonian:
+    ''' A sum of operator terms H = sum_k coeff_k*Op_k, whose local energy is 
+    evaluated in one fused pass: the s' connected to s by every term are 
+    gathered and passed through the network in a single (chunked) batch. '''
+    def __init__(self, op_list=None, coeffs=None):
+        self.Op_list=[]
+        self.coeffs=[]
+        if op_list is not None:
+            if coeffs is None: coeffs=np.ones(len(op_list))
+            for op, coeff in zip(op_list, coeffs):
+                self.add_term(op, coeff)
+        
+    def add_term(self, op, coeff=1):
+        self.Op_list.append(op)
+        self.coeffs.append(coeff)
         
         return
+    
+    # Returns the local energy E_loc(s) of each sample. If per_term, also 
+    # returns the list of [N_samples, L] O_loc arrays of each (scaled) term, 
+    # in the same format as Psi.O_local. 
+    def local_energy(self, psi, s, log_psi_s=None, per_term=False, chunk_size=100000):
+        
+        if torch.is_tensor(s): s=s.numpy()
+        [N_samples,L]=np.shape(s)
+        
+        E_loc=np.zeros(N_samples,dtype=psi.complextype)
+        terms=[]
+        k_idx, n_idx, i_idx, s_primes, mels = [], [], [], [], []
+        for k in range(len(self.Op_list)):
+            diag, nn_, ii, sp, me = self.Op_list[k].connected(s, psi.evals)
+            E_loc+=self.coeffs[k]*np.sum(diag,1)
+            if per_term:
+                O_loc=np.zeros([N_samples,L],dtype=psi.complextype)
+                O_loc[:,:diag.shape[1]]+=self.coeffs[k]*diag
+                terms.append(O_loc)
+            
+            k_idx.append(np.full(len(nn_),k)); n_idx.append(nn_); i_idx.append(ii)
+            s_primes.append(sp); mels.append(self.coeffs[k]*me)
+        
+        n_idx=np.concatenate(n_idx)
+        if len(n_idx)>0: # all diagonal terms need no forward pass at all
+            if log_psi_s is None:
+                log_psi_s=psi.log_psi(torch.tensor(s,dtype=psi.dtype),\
+                                      cache=psi.autoregressive and psi.use_QNADE_cache)
+            # the s' of every term in one (chunked) pass. s' shared between 
+            # terms are not merged, finding them (a sort over all s') cost 
+            # more than the forward passes it saved
+            log_psi_diff=psi.log_psi_prime(np.concatenate(s_primes), s, n_idx,\
+                                           chunk_size)-log_psi_s[n_idx]
+            contrib=np.concatenate(mels)*np.exp(log_psi_diff)
+            E_loc+=np.bincount(n_idx,contrib.real,N_samples)\
+                +1j*np.bincount(n_idx,contrib.imag,N_samples)
+            if per_term:
+                k_idx, i_idx = np.concatenate(k_idx), np.concatenate(i_idx)
+                for k in range(len(terms)):
+                    sel=(k_idx==k)
+                    np.add.at(terms[k],(n_idx[sel],i_idx[sel]),contrib[sel])
+            if psi.autoregressive: psi.QNADE_cache=None # only valid for this s
+        
+        if per_term:
+            return E_loc, terms
+        return E_loc
 
 '''###################### Complex Psi ######################################'''
 # can change all s to self.samples if running optimization
@@ -40,6 +162,17 @@ class Psi:
         self.complex=0
         self.L=L
         self.samples=0
+        
+        # Markov chain positions and their ln|Psi| kept between sample_MH calls,
+        # param_version changes with any in place change of the params, so 
+        # stale amplitudes are redone
+        self.chain_state=None
+        self.chain_log_amp=None
+        self.chain_version=-1
+        self.Ok_cache=None # O_k matrix of compute_Ok and the s it was taken on
+        self.KFAC_factors={} # running K-FAC factors of each layer, see KFAC
+        self.optimizer=None # torch.optim optimizer and lr scheduler, see set_optimizer
+        self.scheduler=None
         self.form=form
         self.re=False
         if self.form.lower()=='real': self.re=True # no imag_comp if net is real
@@ -61,21 +194,43 @@ class Psi:
             self.real_comp=real_comp.double() # converts model params to double acc.
             if not self.re: self.imag_comp=imag_comp.double()
             self.complextype=np.complex128
+            self.ctype=torch.complex128
         else:
             self.real_comp=real_comp
             if not self.re: self.imag_comp=imag_comp
             self.complextype=np.complex64
+            self.ctype=torch.complex64
+        
+        # lookup from an eval to its position in self.evals (sorted or not), 
+        # built once and used to gather the conditional of each entered s_i
+        self.eval_sorter=torch.as_tensor(np.argsort(self.evals))
+        self.evals_sorted=torch.tensor(np.sort(self.evals),dtype=self.dtype)
             
         # Boolean of the class specifying if it is an autoregressive model
         self.autoregressive=autoregressive # default is false
         if self.autoregressive: # Adding autoregressive specific properties
             self.wvf=0 # accumulated psi
-            
-            # These are extra properties/traits the Autoregressive QNADE code needs
-            self.supported_layers = ['Linear'] # TODO: add 'conv' was capability is added
-            assert(self.L==imag_comp[0].in_features), 'incompatible real and imaginary input sizes'
-            assert(self.L*len(self.evals)==self.real_comp[-1].out_features), \
-            'The final/output layer size must be equal to the system size times the number of evals'
+            self.QNADE_cache=None # reference pass kept by QNADE_pass(cache=True)
+            # O_local reuses the cached pass over s for its s' (QNADE_pass_partial),
+            # set False to evaluate each s' by a full pass, without the cache's 
+            # [L,N_samples,H] hidden pre-activations ever being held
+            self.use_QNADE_cache=True
+
+            # Masked (MADE-style) networks give every conditional from one
+            # forward pass, with the MADE output layout outc[:,d::L] for site d
+            masked_r=[m for m in self.real_comp.modules() if m.__class__.__name__=='MaskedLinear']
+            self.masked=len(masked_r)>0
+            if self.masked:
+                assert(self.L*len(self.evals)==masked_r[-1].out_features), \
+                'The final/output layer size must be equal to the system size times the number of evals'
+                # sites are sampled in the autoregressive order of the masks
+                self.order=np.argsort(getattr(self.real_comp,'m',{}).get(-1,np.arange(self.L)))
+            else:
+                # These are extra properties/traits the Autoregressive QNADE code needs
+                self.supported_layers = ['Linear'] # TODO: add 'conv' was capability is added
+                assert(self.L==imag_comp[0].in_features), 'incompatible real and imaginary input sizes'
+                assert(self.L*len(self.evals)==self.real_comp[-1].out_features), \
+                'The final/output layer size must be equal to the system size times the number of evals'
             
             
     # Method to return the complex number specified by the state of the 
@@ -111,12 +266,63 @@ class Psi:
             
         return self.complex
 
+    # Method to return the complex log amplitude ln(Psi(s)) for each sample.
+    # Used as the reference amplitude when taking ratios Psi(s')/Psi(s).
+    def log_psi(self, s, cache=False):
+
+        if self.autoregressive: # cache keeps the pass over s for log_psi_prime
+            log_wvf, _ = self.QNADE_pass(x=s, return_log=True, cache=cache)
+            return log_wvf
+
+        # cast to complex so that negative amplitudes (form='real') are valid
+        return np.log(self.complex_out(s).astype(self.complextype)).flatten()
+
+    # Evaluates ln(Psi) over a large stack of configurations in chunks of at most
+    # chunk_size samples, which caps the memory used by any single forward pass
+    def log_psi_chunked(self, s, chunk_size=100000):
+        
+        log_psi=np.zeros(s.shape[0],dtype=self.complextype)
+        for c in range(0, s.shape[0], chunk_size):
+            log_psi[c:c+chunk_size]=self.log_psi(torch.tensor(s[c:c+chunk_size],\
+                   dtype=self.dtype))
+        
+        return log_psi
+
+    # ln(Psi) of the configurations s_prime connected to the reference samples
+    # s[ref_idx]. Autoregressive models reuse the cached pass over s, so only 
+    # the conditionals from the first changed site onwards are recomputed.
+    def log_psi_prime(self, s_prime, s, ref_idx, chunk_size=100000):
+        
+        # masked networks already evaluate each s' in a single forward pass
+        if not self.autoregressive or self.masked or not self.use_QNADE_cache:
+            return self.log_psi_chunked(s_prime, chunk_size)
+        
+        s=torch.as_tensor(s,dtype=self.dtype)
+        cache=self.QNADE_cache
+        if cache is None or cache['version']!=self.param_version \
+            or not torch.equal(cache['x'],s):
+            self.QNADE_pass(x=s, cache=True)
+        
+        log_psi=np.zeros(s_prime.shape[0],dtype=self.complextype)
+        for c in range(0, s_prime.shape[0], chunk_size):
+            log_psi[c:c+chunk_size]=self.QNADE_pass_partial(s_prime[c:c+chunk_size],\
+                   ref_idx[c:c+chunk_size])
+        
+        return log_psi
+
     '''############################ O_local #######################################
-    Now find O_local where O is an arbitrary operator acting on sites entered. This 
-    function returns the O_local operator summed over the 'allowed' transitions 
-    between the given input spin s and any non-zero transition to spin config s'. 
-    This operator also depends upon the current wavefunction psi. '''
-    def O_local(self, operator, s): 
+    Now find O_local where O is an arbitrary operator acting on sites entered. This
+    function returns the O_local operator summed over the 'allowed' transitions
+    between the given input spin s and any non-zero transition to spin config s'.
+    This operator also depends upon the current wavefunction psi.
+    log_psi_s is the reference ln(Psi(s)). It only depends on s, so it is computed
+    once per call, or can be entered when several operators act on the same s.
+    Only the s' with a nonzero matrix element are evaluated (see Op.connected).
+    With batched=True every s' of every site is stacked and evaluated together 
+    in forward passes of at most chunk_size configurations, rather than one 
+    forward pass per site. Autoregressive models evaluate the s' from a cached 
+    pass over s (see use_QNADE_cache), which is released before returning. '''
+    def O_local(self, operator, s, log_psi_s=None, batched=False, chunk_size=100000):
         
         # Testing if it is a Hamiltonian object
     #    if hasattr(operator,'Op_list'):
@@ -142,81 +348,36 @@ class Psi:
             raise ValueError('Operator size ', op_size, ' does not match the number' \
                              ' of sites entered ', op_span, 'to be acted upon')
         
-        O_loc=np.zeros([N_samples,L],dtype=self.complextype) 
+        O_loc=np.zeros([N_samples,L],dtype=self.complextype)
         #this construction allows us to get local expectation vals
         # and the energy for each sample (which we can use to backprop)
+
+        # Only the s' connected to s by a nonzero matrix element are generated,
+        # the diagonal elements (s'=s) are added directly without a forward pass
+        diag, n_idx, i_idx, s_primes, mels = operator.connected(s, evals)
+        O_loc[:,:n_sites]+=diag
         
-        # cycle through the sites and apply each operator to state s_i (x s_i+1...)
-        for i in range(n_sites):
-            
-            s_prime=s.copy() # so it's a fresh copy each loop
-            
-            # Set up spin config representation in Sz basis for just the acted upon spins
-            # need to generalize for arbitrary spin
-            sz_basis=np.zeros([N_samples,op_span,dim])
-            s_loc=s[:,sites[i]]
-            # can iterate over this for spin!=0.5. use evals
-            sz_basis[np.where(s_loc==1)[0],np.where(s_loc==1)[1],:]=np.array([1,0]) 
-            sz_basis[np.where(s_loc==-1)[0],np.where(s_loc==-1)[1],:]=np.array([0,1])
-            
-            if op_span>1: # extend the size of the basis for multi-site operators
-                basis=sz_basis[:,0,:]
-                for j in range(1,op_span): 
-                    basis=np.einsum('nk,nl->nkl',basis,sz_basis[:,j,:]).reshape(basis.shape[0],-1)
-                    # einstein summation func, forces kron product over 2nd axis by 
-                    # by taking matching inputs from the nth col, avoids kron over samples
-                    # cycle through the states acted on by the multi-site operator
-            else:
-                basis=sz_basis[:,0,:]
-                
-            # S[sites[i]] transformed by Op still in extended basis
-            # Should not matter which side the operator acts on as Op must be hermitian
-            # as we act on the left here, 
-            xformed_state=np.squeeze(np.matmul(basis,operator.matrix)) 
-            
-    #        if np.all((basis>0)==(np.abs(xformed_state)>0)):
-    #            # can skip changing s', nothing's changed in the basis
-    #            basis[basis==0]=1 # just doing this so that there's no division by 0
-    #            div=xformed_state/basis
-    #            multiplier=div[div>0] 
-    #            # returns all of the differences in magnitude of the otherwise unchanged basis state
-    #            pass
-    #        else:
-    
-            # just so the alg can handle single sample input. adds a singleton dim
-            if len(xformed_state.shape)==1:
-                xformed_state=xformed_state[None,:]
-    
-            ## Generating all possible permutations of the local spins
-            perms=np.array(list(itertools.product(evals,repeat=op_span)))
-            
-            # do a loop over all of the possible permutations
-            for kk in range(len(perms)): # xformed_state.shape[1]
-                
-                # change the local spins in s' for each config
-                s_prime[:,sites[i]]=perms[-(kk+1)]
-                # -(kk+1) is used because the ordering is opposite of how the 
-                # slicing is organized. Ex, -1,-1 corresponds to the last 
-                # slice (0,0,0,1) and 1,1 to the first (1,0,0,0) with the 
-                # 1 state = (1,0) and -1 state = (0,1) convention.
-                
-                if self.autoregressive:
-                    wvf_prime, _ = self.QNADE_pass(x=torch.tensor(s_prime,dtype=self.dtype))
-                    _, _ = self.QNADE_pass(x=torch.tensor(s,dtype=self.dtype)) # will update self.wvf
-                    log_psi_diff=np.log(wvf_prime)-np.log(self.wvf)
-                    O_loc[:,i]+= xformed_state[:,kk]*np.exp(log_psi_diff)
-                elif self.form.lower()=='real': # log sensitive when real
-                    psi_div=self.complex_out(torch.tensor(s_prime,\
-                    dtype=self.dtype)).flatten()/self.complex_out(\
-                    torch.tensor(s,dtype=self.dtype)).flatten()
-                    O_loc[:,i]+= xformed_state[:,kk]*psi_div
-                else:
-                    log_psi_diff=np.log(self.complex_out(torch.tensor(s_prime,\
-                    dtype=self.dtype)).flatten())-np.log(self.complex_out(\
-                    torch.tensor(s,dtype=self.dtype))).flatten()
-                    O_loc[:,i]+= xformed_state[:,kk]*np.exp(log_psi_diff)
-                # each slice of the transformed state acts as a multiplier to 
-                # its respective local spin configuration state
+        if len(n_idx)==0: # diagonal operator, nothing left to evaluate
+            return O_loc
+        
+        # psi(s) never changes within the call, only the s' do
+        if log_psi_s is None:
+            log_psi_s=self.log_psi(torch.tensor(s,dtype=self.dtype),\
+                                   cache=self.autoregressive and self.use_QNADE_cache)
+        
+        if batched: # one (chunked) forward pass over every s' of every site
+            log_psi_diff=self.log_psi_prime(s_primes,s,n_idx,chunk_size)-log_psi_s[n_idx]
+            np.add.at(O_loc,(n_idx,i_idx),mels*np.exp(log_psi_diff))
+        else: # a forward pass over the s' of each site
+            for i in np.unique(i_idx):
+                sel=(i_idx==i)
+                log_psi_diff=self.log_psi_prime(s_primes[sel],s,n_idx[sel],\
+                    s_primes.shape[0])-log_psi_s[n_idx[sel]]
+                np.add.at(O_loc[:,i],n_idx[sel],mels[sel]*np.exp(log_psi_diff))
+                # each matrix element acts as a multiplier to its respective 
+                # local spin configuration state
+        
+        if self.autoregressive: self.QNADE_cache=None # only valid for this s
                     
         return O_loc
 
@@ -225,34 +386,29 @@ class Psi:
     '''##################### Energy Gradient ############################'''
     ''' This method will apply the energy gradient to each ANN network param for 
     a given form of Psi. It does simple gradient descent (no SR or anything).
-    It does so given an E_local, Energy E, and wavefunc Psi over sample set s.'''
+    It does so given an E_local, Energy E, and wavefunc Psi over sample set s.
+    The gradient is 2Re(<(E_loc-E0)^* O_k>). If the O_k matrix of compute_Ok is 
+    already stored for s it is reused, otherwise the E_arg weighted sum over the 
+    samples is contracted per layer by autograd_hacks.compute_weighted_grad, 
+    without keeping any per sample gradients (memory O(N_params)). '''
 
     def energy_gradient(self, s, E_loc, E0=None):#, cutoff=1e-8): 
         
         if E0 is None:
             E0=np.real(np.mean(E_loc))
-            
-        N_samples=s.shape[0]
         
-#        if self.autoregressive:
-            
-        # Calculate all of the different multipliers for each form
-        if self.form.lower()=='vector':               
-            m_r=(1/self.complex_out(s)).squeeze()
-            m_i=1j*m_r
-            
-        elif self.form.lower()=='euler' or self.form.lower()=='exponential'\
-             or self.form.lower()=='real':
-                 
-            if self.form.lower()=='euler' or self.form.lower()=='real':
-                m_r=1/self.real_comp(s).detach().numpy().squeeze()
-                
-            else:
-                m_r=(np.ones([N_samples,1])).squeeze()
-            m_i=(np.ones([N_samples,1])*1j).squeeze()            
-            
         E_arg=(np.conj(E_loc)-np.conj(E0))
         
+        Ok=self._Ok_cached(s)
+        if Ok is not None:
+            self._set_grad(self.Ok_force(Ok, E_arg))
+            self.Ok_cache=None # N_samples x N_params, not held past its use
+            return
+        
+        N_samples=s.shape[0]
+        m_r, m_i = self._Ok_mult(s)
+        E_arg=torch.as_tensor(E_arg).to(self.ctype)
+        
         for ii in range(2):
             if ii==0: # Compute GD for real component
                 model=self.real_comp; m=m_r
@@ -263,22 +419,15 @@ class Psi:
             
             if not hasattr(model,'autograd_hacks_hooks'):             
                 autograd_hacks.add_hooks(model)
-            outr=model(s)
-            outr.mean().backward()
-            autograd_hacks.compute_grad1(model) #computes grad per sample for all samples
+            autograd_hacks.clear_backprops(model) # stale backprops of other passes
+            model(s).mean().backward()
+            # force/DE term, weighted sum of the per sample grads
+            autograd_hacks.compute_weighted_grad(model, torch.real(2*E_arg*m)/N_samples)
+            autograd_hacks.clear_backprops(model)
             
-            pars=list(model.parameters())
-                
-            for param in pars:
-                if len(param.size())==2:#different mat mul rules depending on mat shape
-                    ein_str="i,ijk->ijk"
-                elif len(param.size())==1:
-                    ein_str="i,ik->ik"
-                with torch.no_grad():      
-                    param.grad=torch.einsum(ein_str,torch.tensor(np.real(2*E_arg*m)\
-                    ,dtype=self.dtype),param.grad1).mean(0) # force/DE term
+            for param in model.parameters():
+                param.grad=param.weighted_grad
             
-            autograd_hacks.clear_backprops(model)
             # exits for loop so it is only applied to real comp
             if self.form.lower()=='real':
                 break 
@@ -328,10 +477,8 @@ class Psi:
         # for the vector gradients below
             
         elif self.form.lower()=='vector':
-            if np.all(self.complex==0): 
-        # could create errors if doesn't use the updated ppsi and new s
-        # but each call of O_local redefines the .complex
-                self.complex_out(s) # define self.complex
+            # psi(s) of these samples, self.complex may hold the s' of O_local
+            self.complex_out(s)
               
             # hooks accumulate the gradient per sample into layers.backprops_list
             # only called once otherwise extra grads are accumulated
@@ -375,170 +522,498 @@ class Psi:
             
         return 
 
-    '''################# Autoregressive Gradient Descent ###################'''
+    # position of each entry of s in self.evals, with the same shape as s
+    def eval_index(self, s):
+        s=torch.as_tensor(s,dtype=self.dtype).contiguous()
+        return self.eval_sorter[torch.searchsorted(self.evals_sorted,s)]
 
+    '''################# Autoregressive Gradient Descent ###################'''
+    ''' The conditional of site d is psi_d(s_d) ~ exp(v_d(s_d)), v being the 
+    complex_out of the masked network, so Re(dln(Psi(s))/dw) is a weighted sum 
+    of the derivatives of the network outputs. The weights of every site and 
+    eval are formed at once (_autoregressive_mult), and a single backward pass 
+    of the weighted outputs gives the energy gradient, or the per sample O_k 
+    through the autograd_hacks hooks, instead of one pass per site and eval. '''
     def autoregressive_grad(self, E_loc, s, evals, comp):
-        N_samples=s.shape[0]
-        if comp.lower()=='real':
-            model=self.real_comp
-        else: model=self.imag_comp
         
-#        E0=np.real(np.mean(E_loc))
+        if self.re and comp.lower()!='real': # form real only has real_comp
+            return
+        
+        model, mult = self._autoregressive_mult(s, evals, comp)
+        
         E_arg=(np.conj(E_loc)-np.conj(np.mean(E_loc)))
+        E_mult=torch.tensor(2*np.real(E_arg),dtype=self.dtype)
+        
+        model.zero_grad()
+        out=model(s)
+        (E_mult*torch.sum(out*mult,1)).mean().backward()
+        # per sample backprops are not needed here, keep them from piling up
+        if hasattr(model,'autograd_hacks_hooks'):
+            autograd_hacks.clear_backprops(model)
+            
+        return
+    
+    # Per sample O_k=Re(dln(Psi(s))/dw) for the parameters of comp, from one 
+    # backward pass. Also kept in param.grad1 as with autograd_hacks.compute_grad1
+    def autoregressive_Ok(self, s, evals, comp):
+        
+        model, mult = self._autoregressive_mult(s, evals, comp)
         
-        # Get my list of vis
-        outc=self.complex_out(s)
         if not hasattr(model,'autograd_hacks_hooks'):             
             autograd_hacks.add_hooks(model)
+        model.zero_grad()
+        autograd_hacks.clear_backprops(model) # stale backprops of other passes
         out=model(s)
-        pars=list(model.parameters())
-        
-        # initializing some numpy lists to record both the Ok and be a temporary holder
-        # for the grad of each eval (which changes each ii, kk loop, but most efficient to initalize once)
-        E_grad= [[] for i in range(len(pars))]
-        gradii= [[] for i in range(len(pars))]
-#        model.zero_grad()
-        for rr in range(len(pars)):
-            if len(pars[rr].size())==2:
-                [sz1,sz2]=[pars[rr].size(0),pars[rr].size(1)]
-            else:
-                [sz1,sz2]=[pars[rr].size(0),1]
-            E_grad[rr]=np.zeros([sz1,sz2],dtype=complex)
-            gradii[rr]=np.zeros([N_samples,sz1,sz2,len(evals)])
+        torch.sum(out*mult,1).mean().backward()
+        autograd_hacks.compute_grad1(model) # grad1 of a mean is the per sample grad
+        autograd_hacks.clear_backprops(model)
+        
+        return [param.grad1 for param in model.parameters()]
+    
+    # The network of comp and the weights mult[n,j]=Re(dln(Psi(s_n))/dout_j) of 
+    # its outputs, with the MADE layout (output kk*L+ii is eval kk of site ii)
+    def _autoregressive_mult(self, s, evals, comp):
+        
+        N_samples=s.shape[0]
+        if comp.lower()=='real':
+            model=self.real_comp
+        elif self.re: raise ValueError('form real has no imag_comp to differentiate')
+        else: model=self.imag_comp
+        
+        with torch.no_grad():
+            outr=self.real_comp(s).view(N_samples,len(evals),self.L)
+            if self.re: outi=torch.zeros_like(outr)
+            else: outi=self.imag_comp(s).view(N_samples,len(evals),self.L)
             
-        ## Accumulate O_omega1 over lattice sites (also have to see which s were used)
-        for ii in range(0, self.L): # loop over lattice sites
-            N_samples=s.shape[0]
-            vi=outc[:,ii::self.L] 
-            psi_i=out[:,ii::self.L]
-            si=s[:,ii] # the input/chosen si (what I was missing from prev code/E calc)
-            exp_t=np.exp(2*np.real(vi))
-            norm_term=np.sum(exp_t,1)
-                    
-            for kk in range(len(evals)): # have to get the dpsi separately FROM EACH OUTPUT vi
+            # v and its derivative dv/dout of comp, one kernel for every form
+            vi, dv_r, dv_i = self._autoregressive_v(outr, outi)
+            if comp.lower()=='real': dvi_re=dv_r.real
+            else: dvi_re=dv_i.real
+            
+            # d ln(psi_d(s_d)) = dv(s_d) - sum_kk |psi_d(kk)|^2 Re(dv(kk))
+            born_psi=torch.softmax(2*vi.real,1)
+            selection=(s[:,None,:]==torch.tensor(evals,dtype=s.dtype)[None,:,None])
+            mult=(selection.to(self.dtype)-born_psi)*dvi_re
+            
+        return model, mult.view(N_samples,-1)
+    
+    # The complex v=complex_out of the real and imag outputs for the form of 
+    # Psi, with its derivatives dv/doutr and dv/douti
+    def _autoregressive_v(self, outr, outi):
+        
+        zeros=torch.zeros_like(outr)
+        if self.form.lower()=='exponential': # v=e^(outr+i*outi)
+            vi=torch.exp(torch.complex(outr,outi))
+            return vi, vi, torch.complex(-vi.imag,vi.real)
+        elif self.form.lower()=='euler': # v=outr*e^(i*outi)
+            phase=torch.exp(torch.complex(zeros,outi))
+            vi=outr*phase
+            return vi, phase, torch.complex(-vi.imag,vi.real)
+        elif self.form.lower()=='vector': # v=outr+i*outi
+            return torch.complex(outr,outi), torch.complex(zeros+1,zeros), \
+                torch.complex(zeros,zeros+1)
+        elif self.form.lower()=='real': # v=outr
+            return torch.complex(outr,zeros), torch.complex(zeros+1,zeros), \
+                torch.complex(zeros,zeros)
+        else: raise ValueError('grad for specified form not defined')
 
-                psi_i[:,kk].mean().backward(retain_graph=True) # mean necessary over samples
-                                                    # grad1 will save the per sample grad
-                autograd_hacks.compute_grad1(model)
-                autograd_hacks.clear_backprops(model) 
-                for rr in range(len(pars)):
-                    if len(pars[rr].size())==1:
-                        gradii[rr][...,kk]=pars[rr].grad1.numpy()[...,None]
-                    else:
-                        gradii[rr][...,kk]=pars[rr].grad1.numpy()
-#                        
-            for rr in range(len(pars)): # have to include all pars 
-                grad=gradii[rr]
+    '''############ Per sample log derivatives O_k=dln(Psi)/dw_k #############'''
+    ''' O_k of every parameter of real_comp then imag_comp, a contiguous complex
+    torch tensor shaped [N_samples, N_params], from a single forward, backward 
+    and compute_grad1 per network. It is kept in self.Ok_cache for the s it was 
+    computed on, and used by the next energy_gradient or SR on the same s with 
+    the same params (see param_version), which release it (Ok_cache=None). '''
+    def compute_Ok(self, s):
+        
+        Ok=self._Ok_cached(s)
+        if Ok is not None:
+            return Ok
+        
+        N_samples=s.shape[0]
+        m_r, m_i = self._Ok_mult(s)
+        
+        # preallocated, each parameter fills in its own columns
+        Ok=torch.zeros([N_samples,sum([p.numel() for p in self._Ok_params()])],\
+                       dtype=self.ctype)
+        col=0
+        for ii in range(2):
+            if ii==0: model=self.real_comp; m=m_r
+            else: model=self.imag_comp; m=m_i
             
-                # derivative term (will differ depending on ansatz 'form')
-                if self.form.lower()=='exponential':
-                    if comp.lower()=='real': dvi = np.einsum('il,ijkl->ijkl', vi, grad)
-                    else: dvi = np.einsum('il,ijkl->ijkl', 1j*vi, grad)
-                else: raise ValueError('grad for specified form not defined')
-        
-                st_mult =  np.sum(np.einsum('il,ijkl->ijkl', exp_t, np.real(dvi)),-1)
-                sec_term=np.einsum('i,ijk->ijk', 1/norm_term, st_mult)
-               
-                temp_Ok=np.zeros_like(sec_term,dtype=complex)
-                for kk in range(len(evals)): 
-                    
-                    selection=(si==evals[kk]) # which s were sampled 
-                                                #(which indices correspond to the si)
-                    sel1=selection*1
-                        
-                        # For each eval/si, we must select only the subset vi(si) 
-                    temp_Ok[:]+=np.einsum('i,ijk->ijk',sel1,dvi[...,kk])
-                    
-                E_grad[rr] += np.mean(np.einsum('i,ijk->ijk', 2*np.real(E_arg), \
-                  np.real(temp_Ok-sec_term)),0)
+            model.zero_grad()
+            if not hasattr(model,'autograd_hacks_hooks'):             
+                autograd_hacks.add_hooks(model)
+            autograd_hacks.clear_backprops(model) # stale backprops of other passes
+            model(s).mean().backward()
+            autograd_hacks.compute_grad1(model) #computes grad per sample for all samples
+            autograd_hacks.clear_backprops(model)
             
-            for rr in range(len(pars)):
-                pars[rr].grad=torch.tensor(np.real(E_grad[rr]),dtype=self.dtype).squeeze()
+            with torch.no_grad():
+                for param in model.parameters():
+                    n=param.numel()
+                    Ok[:,col:col+n]=m[:,None]*param.grad1.view([N_samples,-1])
+                    col+=n
+            
+            # exits for loop so it is only applied to real comp
+            if self.form.lower()=='real':
+                break 
+        
+        self.Ok_cache={'x': s.clone(), 'Ok': Ok, 'version': self.param_version}
+        
+        return Ok
+    
+    # The stored O_k if it was computed on s with the current parameters, else None
+    def _Ok_cached(self, s):
+        
+        cache=self.Ok_cache
+        if cache is not None and cache['version']==self.param_version \
+            and cache['x'].shape==s.shape and torch.equal(cache['x'],s):
+            return cache['Ok']
+        
+        return None
+    
+    # The multipliers m=dln(Psi)/d(output) of the real_comp and imag_comp outputs 
+    # for each form, so that O_k=m*d(output)/dw_k
+    def _Ok_mult(self, s):
+        
+        N_samples=s.shape[0]
+        with torch.no_grad():
+            if self.form.lower()=='vector':
+                out=torch.complex(self.real_comp(s),self.imag_comp(s))
+                self.complex=out.numpy() # kept up to date, as complex_out(s) does
+                m_r=1/out.flatten()
+                m_i=1j*m_r
+            elif self.form.lower()=='euler' or self.form.lower()=='exponential'\
+                 or self.form.lower()=='real':
+                if self.form.lower()=='euler' or self.form.lower()=='real':
+                    m_r=(1/self.real_comp(s).flatten()).to(self.ctype)
+                else:
+                    m_r=torch.ones([N_samples],dtype=self.ctype)
+                m_i=1j*torch.ones([N_samples],dtype=self.ctype)
+        
+        return m_r, m_i
+    
+    # The energy gradient (force) F_k=2Re(<E_arg O_k>) with E_arg=(E_loc-E0)^*
+    def Ok_force(self, Ok, E_arg):
+        E_arg=torch.as_tensor(E_arg).to(self.ctype)
+        return 2*torch.real(torch.mv(Ok.t(),E_arg))/Ok.shape[0]
+    
+    # Identifies the current parameter values, for the caches of amplitudes and 
+    # O_k. Every in place change of a param (apply_grad, an optimizer step, 
+    # load_state_dict, ...) bumps its _version, and a replaced param its id.
+    @property
+    def param_version(self):
+        return tuple((id(param), param._version) for param in self._Ok_params())
+    
+    # The parameters in the column order of O_k
+    def _Ok_params(self):
+        params=list(self.real_comp.parameters())
+        if not self.re: params+=list(self.imag_comp.parameters())
+        return params
+    
+    # Column slices of O_k that SR treats as independent blocks of S, 'param' 
+    # for each parameter tensor, 'layer' for the parameters of each layer 
+    # (weight and bias together) and 'full' for the full (coupled) S
+    def _Ok_blocks(self, structure='param'):
+        
+        sizes=[param.numel() for param in self._Ok_params()]
+        if structure.lower()=='full':
+            return [slice(0,int(np.sum(sizes)))]
+        elif structure.lower()=='layer': # a module's params are adjacent in O_k
+            models=[self.real_comp] if self.re else [self.real_comp,self.imag_comp]
+            sizes=[sum([param.numel() for param in layer.parameters(recurse=False)]) \
+                   for model in models for layer in model.modules()]
+            sizes=[n for n in sizes if n>0]
+        elif structure.lower()!='param':
+            raise ValueError('Unknown S structure ', structure, \
+                             ', use "param", "layer", "diag" or "full"')
+        ends=np.cumsum(sizes)
+        return [slice(int(e-n),int(e)) for e, n in zip(ends,sizes)]
+    
+    # Writes a flat vector ordered like the O_k columns into each param.grad
+    def _set_grad(self, vec):
+        
+        start=0
+        for param in self._Ok_params():
+            n=param.numel()
+            param.grad=vec[start:start+n].detach().view(param.size())
+            start+=n
             
-        return # E_grad
+        return
 
     '''################### Stochatic Reconfiguation ########################'''
-
-    def SR(self, s, E_loc, lambduh=1):#, cutoff=1e-8): 
+    ''' Solves (S+lambduh*diag(S)+1e-5)x=F, with S=2Re(<O^H O>-<O>^*<O>) and 
+    F=2Re(<E_arg O>), and writes x into param.grad. 
+    structure picks the blocks of S that are kept: 'param' (default) each 
+    parameter tensor, 'layer' each layer, 'full' all of S, or 'diag' only 
+    diag(S), where x=F/((1+lambduh)diag(S)+1e-5) needs no solver at all. 
+    solver picks how each block is solved: 'cholesky' (default) factorizes it 
+    with PSDSolver (in the 2*N_samples sample space when that is smaller, see 
+    _SR_solve_samples), 'cg' runs Jacobi preconditioned conjugate gradient on 
+    S.v products from O_k, and 'matrix_free' the same cg from the autograd_hacks 
+    activations and backprops, without O_k, for the full S only (its default). 
+    cg_tol (default 1e-8) and cg_max_iter only apply to the cg solvers. 
+    Options that would be ignored (a solver with 'diag', another structure 
+    with 'matrix_free', cg settings without cg) raise a ValueError. 
+    SR_info keeps |F|, |x|, diag(S) and the cg iterations and residuals, and 
+    SR_solvers the factorizations (see PSDSolver.cond and rank). '''
+    def SR(self, s, E_loc, lambduh=1, solver=None, cg_tol=None, cg_max_iter=None,
+           structure=None):#, cutoff=1e-8): 
+        
+        if structure is not None and structure.lower()=='diag' and solver is not None:
+            raise ValueError('structure "diag" has no solve, solver ', solver, \
+                             ' would be ignored')
+        solver='cholesky' if solver is None else solver.lower()
+        if solver not in ['cholesky','cg','matrix_free']:
+            raise ValueError('Unknown SR solver ', solver, \
+                             ', use "cholesky", "cg" or "matrix_free"')
+        if solver=='matrix_free' and structure is not None and structure.lower()!='full':
+            raise ValueError('solver "matrix_free" only solves the full S, not '\
+                             'structure ', structure)
+        structure=('full' if solver=='matrix_free' else 'param') if structure is None \
+            else structure.lower()
+        if (solver=='cholesky' or structure=='diag') and \
+            (cg_tol is not None or cg_max_iter is not None):
+            raise ValueError('cg_tol and cg_max_iter only apply to solver "cg" or '\
+                             '"matrix_free"')
+        if cg_tol is None: cg_tol=1e-8
         
         E0=np.real(np.mean(E_loc))
-        N_samples=s.shape[0]
+        E_arg=(np.conj(E_loc)-np.conj(E0))
         
-#        if self.autoregressive:
-            
-        if self.form.lower()=='vector':
-            if np.all(self.complex==0): 
-                self.complex_out(s)
-            m_r=(1/self.complex).squeeze()
-            m_i=1j*m_r
-        elif self.form.lower()=='euler' or self.form.lower()=='exponential'\
-             or self.form.lower()=='real':
-            if self.form.lower()=='euler' or self.form.lower()=='real':
-                m_r=1/self.real_comp(s).detach().numpy().squeeze()
-            else:
-                m_r=(np.ones([N_samples,1])).squeeze()
-            m_i=(np.ones([N_samples,1])*1j).squeeze()            
+        if solver=='matrix_free':
+            force, x, cg_info = self._SR_matrix_free(s, E_arg, lambduh, cg_tol, cg_max_iter)
+            self.SR_solvers=[]
+            self.SR_info={'force_norm': torch.norm(force).item(), 'update_norm': \
+                torch.norm(x).item(), \
+                'cg_iter': [cg_info['iter']], 'cg_residual': [cg_info['residual']]}
+            self._set_grad(x) # SR 'gradient'
+            self.Ok_cache=None
+            return
+        
+        Ok=self.compute_Ok(s)
+        force=self.Ok_force(Ok, E_arg) # force/DE term
+        
+        self.SR_solvers=[]
+        cg_infos=[]
+        if structure=='diag': # no solve, diag(S) from the columns of O_k
+            S_diag=2*(torch.mean(Ok.abs()**2,0)-torch.mean(Ok,0).abs()**2)
+            x=force/((1+lambduh)*S_diag+1e-5)
+        else:
+            x=torch.zeros_like(force)
+            S_diag=torch.zeros_like(force)
+            for blk in self._Ok_blocks(structure):
+                x[blk], S_diag[blk], blk_solver, cg_info = self._SR_solve(Ok[:,blk], \
+                    force[blk], lambduh, solver, cg_tol, cg_max_iter)
+                self.SR_solvers.append(blk_solver) # None for cg
+                if cg_info is not None: cg_infos.append(cg_info)
+        
+        self.SR_info={'force_norm': torch.norm(force).item(), 'update_norm': \
+            torch.norm(x).item(), 'S_diag': S_diag, \
+            'cg_iter': [info['iter'] for info in cg_infos], \
+            'cg_residual': [info['residual'] for info in cg_infos]}
+        self._set_grad(x) # SR 'gradient'
+        self.Ok_cache=None # N_samples x N_params, not held past its use
             
-        E_arg=(np.conj(E_loc)-np.conj(E0))
+        return
+    
+    # Solves (S+lambduh*diag(S)+1e-5)x=F for one block of O_k, returns x, diag(S),
+    # the PSDSolver of the factorized matrix (None for cg) and the conjugate 
+    # gradient info (None unless cg)
+    def _SR_solve(self, Ok, force, lambduh, solver='cholesky', cg_tol=1e-8, cg_max_iter=None):
         
-        for ii in range(2):
-            if ii==0:# Compute SR for real component
-                model=self.real_comp; m=m_r
-            else:
-                model=self.imag_comp; m=m_i
-                
+        N_samples=Ok.shape[0]
+        Exp_Ok=torch.mean(Ok,0)
+        Ok_centered=Ok-Exp_Ok[None,:]
+        # S=2Re(<O^H O>-<O>^*<O>) is the real part of the centered O_k outer product
+        S_diag=2*torch.mean(Ok_centered.abs()**2,0)
+        
+        if solver.lower()=='cg': # matrix free, only O.v and O^H.u products
+            Ok_H=Ok.conj().t()
+            def S_mv(v):
+                v_c=v.to(Ok.dtype)
+                Sv=2*torch.real(torch.mv(Ok_H,torch.mv(Ok,v_c))/N_samples\
+                   -Exp_Ok.conj()*torch.dot(Exp_Ok,v_c))
+                return Sv+(lambduh*S_diag+1e-5)*v # same regulation as below
+            # Jacobi preconditioner, the diagonal of the regulated S
+            x, cg_info = conjugate_gradient(S_mv, force, tol=cg_tol, max_iter=cg_max_iter, \
+                                            M_inv=1/((1+lambduh)*S_diag+1e-5))
+            return x, S_diag, None, cg_info
+        
+        if 2*N_samples<Ok.shape[1]: # S would be larger than the sample space
+            x, T_solver = self._SR_solve_samples(Ok_centered, force, lambduh*S_diag+1e-5)
+            return x, S_diag, T_solver, None
+        
+        # real matmuls of the real and imag parts, cheaper than a complex one
+        S=2*(torch.mm(Ok_centered.real.t(),Ok_centered.real)\
+             +torch.mm(Ok_centered.imag.t(),Ok_centered.imag))/N_samples
+        # folowing same reg/style as senior design matlab code
+        S_solver=PSDSolver(S+torch.diag(lambduh*torch.diag(S)+1e-5)) # regulation term
+        
+        return S_solver.solve(force), S_diag, S_solver, None
+    
+    # Full S conjugate gradient SR without O_k. With O_k=m*g_k (g the per sample 
+    # gradient of the network output), O.v=m*jvp(v) and, g being real, 
+    # Re(O^H u)=vjp(Re(m^* u)), so S.v=2vjp(Re(m^* O.v))/N-2Re(<O>^*(<O>.v)). 
+    # diag(S) comes from the weighted squared gradients. Returns F, x and the 
+    # conjugate gradient info.
+    def _SR_matrix_free(self, s, E_arg, lambduh, cg_tol=1e-8, cg_max_iter=None):
+        
+        N_samples=s.shape[0]
+        m_r, m_i = self._Ok_mult(s)
+        E_arg=torch.as_tensor(E_arg).to(self.ctype)
+        
+        models=[[self.real_comp,m_r]]
+        if not self.re: models.append([self.imag_comp,m_i])
+        
+        # the backprops are kept for every product until the solve is done
+        for model, m in models:
             model.zero_grad()
+            if not hasattr(model,'autograd_hacks_hooks'):             
+                autograd_hacks.add_hooks(model)
+            autograd_hacks.clear_backprops(model) # stale backprops of other passes
+            model(s).mean().backward()
+        
+        def vjp(weights): # flat sum_n weights_n*g_n over every parameter
+            return torch.cat([grad.flatten() for model, m in models for grad in \
+                autograd_hacks.compute_vjp(model, torch.real(weights(m)))])
+        
+        sizes=[[param.numel() for param in model.parameters()] for model, m in models]
+        def jvp(v): # O.v, v a flat vector over every parameter
+            Ov, start = torch.zeros([N_samples],dtype=self.ctype), 0
+            for (model, m), size in zip(models, sizes):
+                v_model=[]
+                for param, n in zip(model.parameters(), size):
+                    v_model.append(v[start:start+n].view(param.size()))
+                    start+=n
+                Ov=Ov+m*autograd_hacks.compute_jvp(model, v_model)
+            return Ov
+        
+        force=vjp(lambda m: 2*E_arg*m/N_samples) # force/DE term
+        Exp_Ok=vjp(lambda m: m/N_samples)+1j*vjp(lambda m: -1j*m/N_samples)
+        
+        S_diag=[]
+        for model, m in models:
+            autograd_hacks.compute_weighted_sq_grad(model, torch.abs(m)**2/N_samples)
+            S_diag+=[param.weighted_sq_grad.flatten() for param in model.parameters()]
+        S_diag=2*(torch.cat(S_diag)-torch.abs(Exp_Ok)**2)
+        
+        def S_mv(v):
+            Ov=jvp(v)
+            Sv=2*vjp(lambda m: torch.conj(m)*Ov)/N_samples\
+               -2*torch.real(Exp_Ok.conj()*torch.dot(Exp_Ok,v.to(self.ctype)))
+            return Sv+(lambduh*S_diag+1e-5)*v # same regulation as the dense SR
+        x, cg_info = conjugate_gradient(S_mv, force, tol=cg_tol, max_iter=cg_max_iter, \
+                                        M_inv=1/((1+lambduh)*S_diag+1e-5))
+        
+        for model, m in models:
+            autograd_hacks.clear_backprops(model)
+        
+        return force, x, cg_info
+    
+    # (S+D)x=F in the sample space for a diagonal regulation D. With the centered 
+    # O_k, S=X^T X where X=sqrt(2/N)[Re(O_k); Im(O_k)] is [2*N_samples, N_params], 
+    # and by the Woodbury identity x=D^-1 F-D^-1 X^T (I+X D^-1 X^T)^-1 X D^-1 F, 
+    # so only a 2N_samples x 2N_samples system (T=O O^H and its c.c.) is solved.
+    # Returns x and the PSDSolver of T.
+    def _SR_solve_samples(self, Ok_centered, force, D):
+        
+        N_samples=Ok_centered.shape[0]
+        X=np.sqrt(2/N_samples)*torch.cat((Ok_centered.real,Ok_centered.imag),0)
+        y=force/D
+        T_solver=PSDSolver(torch.eye(2*N_samples,dtype=X.dtype)+torch.mm(X/D[None,:],X.t()))
+        
+        return y-torch.mv(X.t(),T_solver.solve(torch.mv(X,y)))/D, T_solver
+
+    
+    '''############ Kronecker factored (K-FAC) natural gradient ##############'''
+    ''' An approximation of SR that treats each layer as an independent block of 
+    the (uncentered) S and factorizes it as S_layer~<A^T A> x 2<|m|^2 B^T B>, 
+    from the activations A and backprops B of autograd_hacks, so only the small 
+    [in,in] and [out,out] factors are inverted, i.e. the update of a layer is 
+    B_f^-1 F A_f^-1 with F its force in matrix form. The factors are running 
+    averages over calls, factor=decay*factor+(1-decay)*new, kept per layer in 
+    self.KFAC_factors, and each is damped by sqrt(lambduh). Parameters outside 
+    of the supported layers keep their energy gradient. Unlike SR, whose S is 
+    centered (2Re(<O^H O>-<O>^*<O>)), the factors approximate the uncentered 
+    2Re<O^H O>: <O> does not split into per layer factors, and the dropped 
+    term is only a rank <=2 part of each block, small when <O_k>~0. '''
+    def KFAC(self, s, E_loc, lambduh=1e-3, decay=0.95):
+        
+        E0=np.real(np.mean(E_loc))
+        E_arg=torch.as_tensor(np.conj(E_loc)-np.conj(E0)).to(self.ctype)
+        
+        N_samples=s.shape[0]
+        m_r, m_i = self._Ok_mult(s)
+        gamma=np.sqrt(lambduh)
+        
+        self.KFAC_solvers=[]
+        for ii in range(2):
+            if ii==0: model=self.real_comp; m=m_r
+            else: model=self.imag_comp; m=m_i
             
+            model.zero_grad()
             if not hasattr(model,'autograd_hacks_hooks'):             
                 autograd_hacks.add_hooks(model)
-            outr=model(s)
-            outr.mean().backward()
-            autograd_hacks.compute_grad1(model) #computes grad per sample for all samples
+            autograd_hacks.clear_backprops(model) # stale backprops of other passes
+            model(s).mean().backward()
+            # force/DE term and the factors from the same activations and backprops
+            autograd_hacks.compute_weighted_grad(model, torch.real(2*E_arg*m)/N_samples)
+            autograd_hacks.compute_kfac_factors(model, 2*torch.abs(m)**2)
             autograd_hacks.clear_backprops(model)
-            pars=list(model.parameters())
+            
+            for param in model.parameters():
+                param.grad=param.weighted_grad
+            
+            for layer in model.modules():
+                if not autograd_hacks.is_supported(layer):
+                    continue
+                A_f, B_f = layer.kfac_A, layer.kfac_B
+                if layer in self.KFAC_factors:
+                    A_f=decay*self.KFAC_factors[layer][0]+(1-decay)*A_f
+                    B_f=decay*self.KFAC_factors[layer][1]+(1-decay)*B_f
+                self.KFAC_factors[layer]=[A_f, B_f]
+                
+                A_solver=PSDSolver(A_f+gamma*torch.eye(A_f.shape[0],dtype=A_f.dtype))
+                B_solver=PSDSolver(B_f+gamma*torch.eye(B_f.shape[0],dtype=B_f.dtype))
+                self.KFAC_solvers+=[A_solver, B_solver]
                 
-            for param in pars:
-                with torch.no_grad():      
-                    par_size=param.size() # record original param shape for reshaping
-                    Ok=np.einsum("i,ik->ik",m,param.grad1.view([N_samples,-1]).numpy())
-                    Exp_Ok=np.mean(Ok,0)[:,None] # gives another axis, necessary for matmul
-            #        T1=np.tensordot(np.conj(Ok_list[kk]),Ok_list[kk].T, axes=((0,2),(2,0)))/N_samples
-                    T1=np.einsum("kn,mk->nm",np.conj(Ok),Ok.T)/N_samples
-                    # These are methods are equivalent! Good sanity check (einsum more versitile)
-                    S=2*np.real(T1-np.matmul(np.conj(Exp_Ok),Exp_Ok.T))# the S+c.c. term
-                    # folowing same reg/style as senior design matlab code
-#                    l_reg=1e-5*np.eye(T1.shape[0],T1.shape[1]) 
-                    l_reg=lambduh*np.eye(S.shape[0],S.shape[1])*np.diag(S) # regulation term
-#                    l_reg=1e-5*np.diag(np.diag(S)) # regulation term
-#                    S=T1-np.matmul(np.conj(Exp_Ok),Exp_Ok.T)+1e-5*np.eye(T1.shape[0],T1.shape[1]) 
-                    try:
-                        S_inv=np.linalg.inv(S+l_reg+1e-5*np.eye(T1.shape[0],T1.shape[1]))
-                    except np.linalg.LinAlgError:
-                        print('\n\n S matrix: ', S, '\n\n caused singular value error')
-                        raise SystemExit(0)
-#                    S[S<cutoff]=0
-                    # SVD Inversion alg
-#                    [U,D,VT]=np.linalg.svd(S+l_reg)
-#                    D=np.diag(1/D) # inverting the D matrix, for SVD, M'=V (D^-1) U.T = (U(D^-1)V.T).T
-#                    S_inv=torch.tensor(np.matmul(np.matmul(U,D),VT).T,dtype=self.dtype)
-#                    S_inv=torch.tensor(np.linalg.pinv(S+l_reg),dtype=self.dtype) # S^-1 term with reg
-                    force=torch.einsum("i,ik->ik",torch.tensor(np.real(2*E_arg*m)\
-                    ,dtype=self.dtype),param.grad1.view([N_samples,-1])).mean(0) # force/DE term
-                    # Compute SR 'gradient'
-                    param.grad=torch.tensor(np.real(np.matmul(S_inv,force[:,None]\
-                    .detach().numpy())),dtype=self.dtype).view(par_size).detach() 
-#                    param.grad=torch.mm(S_inv,force[:,None]).view(par_size).detach() 
+                # [out, in(+1 for the bias)] force of the layer
+                F=layer.weight.weighted_grad.view(layer.weight.shape[0],-1)
+                if layer.bias is not None:
+                    F=torch.cat((F,layer.bias.weighted_grad[:,None]),1)
+                X=A_solver.solve(B_solver.solve(F).t()).t()
+                if layer.bias is not None:
+                    layer.bias.grad=X[:,-1].contiguous()
+                    X=X[:,:-1]
+                X=X.reshape(layer.weight.shape)
+                if hasattr(layer,'mask'): X=X*layer.mask # same mask as the weights
+                layer.weight.grad=X
             
             # exits for loop so it is only applied to real comp
             if self.form.lower()=='real':
                 break 
-            
+        
+        params=self._Ok_params()
+        self.KFAC_info={'force_norm': torch.norm(torch.cat([param.weighted_grad.flatten() \
+            for param in params])).item(), 'update_norm': torch.norm(torch.cat(\
+            [param.grad.flatten() for param in params])).item()}
+        
         return
 
+
     '''####### Apply the gradient generated from SR or Grad. Descent ########'''
-    ''' Potential improvement- optimization routines for lr (Adam,momentum, pytorch optimizers?)'''
+    ''' Without an optimizer the step is param-=lr*param.grad. After 
+    set_optimizer, the .grad left by energy_gradient, SR or KFAC is instead 
+    applied by optimizer.step() (lr is then the optimizer's) and the scheduler, 
+    if any, is stepped once per call. '''
     def apply_grad(self, lr=0.03):
         
+        if self.optimizer is not None:
+            self.optimizer.step()
+            if self.scheduler is not None: self.scheduler.step()
+            return
+        
         params_r=list(self.real_comp.parameters()) # get the parameters
         if not self.re: params_i=list(self.imag_comp.parameters())    
         
@@ -558,10 +1033,53 @@ class Psi:
         
         return
     
+    ''' Any torch.optim optimizer class (e.g. torch.optim.Adam) over the params 
+    of real_comp and imag_comp, built with kwargs (lr, momentum, ...). scheduler 
+    is an optional function of the optimizer returning its lr scheduler, e.g. 
+    lambda opt: torch.optim.lr_scheduler.ExponentialLR(opt,0.99). '''
+    def set_optimizer(self, optimizer, scheduler=None, **kwargs):
+        
+        self.optimizer=optimizer(self._Ok_params(), **kwargs)
+        self.scheduler=None if scheduler is None else scheduler(self.optimizer)
+        
+        return
+    
+    # Checkpoint of the networks and the optimizer/scheduler states (momenta etc.), 
+    # e.g. for torch.save, restored by load_state_dict
+    def state_dict(self):
+        
+        state={'real_comp': self.real_comp.state_dict()}
+        if not self.re: state['imag_comp']=self.imag_comp.state_dict()
+        if self.optimizer is not None: state['optimizer']=self.optimizer.state_dict()
+        if self.scheduler is not None: state['scheduler']=self.scheduler.state_dict()
+        
+        return state
+    
+    # set_optimizer must be called with the same optimizer before its state is loaded
+    def load_state_dict(self, state):
+        
+        self.real_comp.load_state_dict(state['real_comp'])
+        if not self.re: self.imag_comp.load_state_dict(state['imag_comp'])
+        if 'optimizer' in state: self.optimizer.load_state_dict(state['optimizer'])
+        if 'scheduler' in state: self.scheduler.load_state_dict(state['scheduler'])
+        
+        return
+    
     ''' #################### SAMPLING METHODS ##########################'''
     
     '''#################### MH Sampling function ############################'''
-    def sample_MH(self, N_samples, spin=None, evals=None, s0=None, rot=None):
+    ''' n_chains Markov chains are run in parallel, giving ceil(N_samples/n_chains)
+    recorded samples per chain. s0 may be a single state (shared by all chains) 
+    or one state per chain. Between recorded samples each chain makes thin 
+    steps, where a step is one proposal or, if sweep, L proposals. burn_in steps
+    are discarded before the first sample is recorded. Returns the samples 
+    shaped [n_chains*n_steps, L] and, if return_tau, the integrated 
+    autocorrelation time of the chains (in recorded samples), also kept in 
+    self.tau along with the effective sample size self.N_eff. 
+    The final chain states are kept, and with warm_start the chains continue 
+    from where the previous call ended (burn_in is then the re-equilibration).'''
+    def sample_MH(self, N_samples, spin=None, evals=None, s0=None, rot=None, n_chains=1,
+                  burn_in=0, thin=1, sweep=False, return_tau=False, warm_start=False):
         # need either the explicit evals or the spin 
         if spin is None and evals is None:
             raise ValueError('Either the eigenvalues of the system or the spin\
@@ -580,185 +1098,481 @@ class Psi:
             evals=2*np.arange(-spin,spin+1) # +1 is just so s=spin is included
             # times 2 is just the convention that's been used, spin evals of -1,1
         
-        if s0 is None:
-            s0=np.random.choice(evals,size=self.L)
+        # Each of the n_chains walkers advances one step at a time, all chains 
+        # are proposed and accepted/rejected together as one batch.
+        n_steps=int(np.ceil(N_samples/n_chains))
+        n_moves=self.L if sweep else 1 # proposals per step
         
-        self.samples=np.zeros([N_samples,self.L])
-        self.samples[0,:]=s0
-        for n in range(N_samples-1):
-            
-            pos=np.random.randint(self.L) # position to change
-            
-            alt_state = self.samples[n,:].copy() # next potential state
-            
-            if np.random.rand()>=0.5:
-                alt_state[pos] = np.real(np.exp(1j*rot)*alt_state[pos]) # flip next random position for spin
-            else:
-                alt_state[pos] = np.real(np.exp(-1j*rot)*alt_state[pos]) # same chance to flip other direction
-            # TODO: will have to generalize to complex evals
-            
-            # Probabilty of the next state divided by the current
-            ln_prob=2*(np.log(np.abs(self.complex_out(torch.tensor(alt_state,dtype=self.dtype))))\
-            -np.log(np.abs(self.complex_out(torch.tensor(self.samples[n,:],dtype=self.dtype)))))
-            # hopefully reduces potential divide by 0 errors
-            prob = np.exp(ln_prob)
-#            (np.square(np.abs(self.complex_out(torch.tensor(alt_state,dtype=self.dtype)))))   \
-#            /(np.square(np.abs(self.complex_out(torch.tensor(self.samples[n,:],dtype=self.dtype)))))
-            
-            A = min(1,prob) # Metropolis Hastings acceptance formula
-
-            if A ==1: self.samples[n+1,:]=alt_state
-            else: 
-                if np.random.rand()<A: self.samples[n+1,:]=alt_state # accepting move with prob A
-                else: self.samples[n+1,:] = self.samples[n,:]
-            
+        warm_start = warm_start and s0 is None and self.chain_state is not None \
+            and self.chain_state.shape[0]==n_chains
+        if warm_start:
+            state=self.chain_state.copy()
+        else:
+            if s0 is None:
+                s0=np.random.choice(evals,size=[n_chains,self.L])
+            # a single s0 is used as the starting point of every chain
+            state=np.broadcast_to(np.reshape(s0,[-1,self.L]),[n_chains,self.L]).astype(float)
+        
+        # ln|Psi| of the current state of each chain. Only the proposed states 
+        # need a forward pass, this is updated with them when they are accepted
+        if warm_start and self.chain_version==self.param_version:
+            log_amp=self.chain_log_amp.copy()
+        else: # the parameters changed since the chains were stored
+            log_amp=np.real(self.log_psi(torch.tensor(state,dtype=self.dtype)))
+        
+        for n in range(burn_in*n_moves):
+            state, log_amp = self.MH_step(state, log_amp, rot)
+        
+        self.samples=np.zeros([n_steps,n_chains,self.L])
+        log_amp_trace=np.zeros([n_steps,n_chains]) # used for the autocorrelation
+        self.samples[0], log_amp_trace[0] = state, log_amp
+        for n in range(1,n_steps):
+            for m in range(thin*n_moves):
+                state, log_amp = self.MH_step(state, log_amp, rot)
+            self.samples[n], log_amp_trace[n] = state, log_amp
+        
+        self.chain_state, self.chain_log_amp = state, log_amp
+        self.chain_version=self.param_version
+        
+        # the ln|Psi| of each chain is a cheap observable to estimate tau from, 
+        # if it is flat (e.g. a uniform |Psi|) the magnetization is used instead
+        if np.all(log_amp_trace==log_amp_trace[0]):
+            log_amp_trace=np.sum(self.samples,2)
+        self.tau=integrated_autocorr_time(log_amp_trace)
+        self.N_eff=n_steps*n_chains/self.tau
+        
+        # [n_steps*n_chains, L], ordered by step with the chains interleaved
+        self.samples=self.samples.reshape(-1,self.L)
+        
+        if return_tau:
+            return self.samples, self.tau
         return self.samples
     
+    # A single Metropolis Hastings proposal for every chain in state, given the 
+    # cached ln|Psi| of state. Returns the new states and their ln|Psi|.
+    def MH_step(self, state, log_amp, rot):
+        
+        n_chains=state.shape[0]
+        pos=np.random.randint(self.L,size=n_chains) # position to change, per chain
+        
+        alt_state = state.copy() # next potential states
+        
+        # flip next random position for spin, same chance to flip other direction
+        direction=np.where(np.random.rand(n_chains)>=0.5,1,-1)
+        alt_state[np.arange(n_chains),pos] = np.real(np.exp(1j*rot*direction)\
+                  *alt_state[np.arange(n_chains),pos])
+        # TODO: will have to generalize to complex evals
+        
+        # Probabilty of the next state divided by the current, the proposed 
+        # states of every chain are evaluated in one forward pass
+        log_amp_alt=np.real(self.log_psi(torch.tensor(alt_state,dtype=self.dtype)))
+        ln_prob=2*(log_amp_alt-log_amp)
+        
+        # Metropolis Hastings acceptance, accepting move with prob A=min(1,prob)
+        # (compared in the log domain, avoids overflow of exp(ln_prob))
+        accept=np.log(np.random.rand(n_chains))<ln_prob
+        state=np.where(accept[:,None],alt_state,state)
+        log_amp=np.where(accept,log_amp_alt,log_amp) # keep the cache consistent
+        
+        return state, log_amp
+    
     '''########## Autoregressive Sampling and Ppsi Gen function ############'''
            
-    def QNADE_pass(self, N_samples=None, x=None, grad_required=False): 
+    ''' Either generates N_samples by exact autoregressive sampling, or gives the 
+    Psi of the entered spin states x. The pass stays in torch throughout, the 
+    samples are drawn with torch.multinomial using generator (a torch.Generator 
+    or an int seed) when one is entered. Psi is accumulated as ln(Psi), which 
+    is returned directly if return_log (Psi itself underflows for large L). 
+    With cache, the per site hidden pre-activations a_d and the conditionals 
+    of the pass are kept in self.QNADE_cache for QNADE_pass_partial.
+    Masked (MADE-style) networks are evaluated with _MADE_pass instead, where
+    an entered x needs a single forward pass (cache is not used there). '''
+    def QNADE_pass(self, N_samples=None, x=None, grad_required=False, generator=None,
+                   return_log=False, cache=False): 
                 
         if N_samples is None and x is None: 
             raise ValueError('Must enter spin states for Psi calculation or the number of samples to be generated')
         if N_samples is None and x is not None: N_samples, sample = x.shape[0], False
         if N_samples is not None and x is None: sample = True
-                
-        real_modules = list(self.real_comp.children())
-        imag_modules = list(self.imag_comp.children())
-                
-        for jj in range(len(real_modules)):
-            if real_modules[jj].__class__.__name__ in self.supported_layers:
-                last_linear_r = jj
         
-        for jj in range(len(imag_modules)):
-            if imag_modules[jj].__class__.__name__ in self.supported_layers:
-                last_linear_i = jj
+        if isinstance(generator, int): 
+            generator=torch.Generator().manual_seed(generator)
+        
+        with torch.set_grad_enabled(grad_required):
+            if self.masked:
+                LOG_PPSI, samples = self._MADE_pass(N_samples, x, sample, generator)
+            else:
+                LOG_PPSI, samples = self._QNADE_pass(N_samples, x, sample, generator, cache)
+        
+        self.log_wvf=LOG_PPSI
+        self.wvf=np.exp(LOG_PPSI)
+        
+        if return_log:
+            return LOG_PPSI, samples
+        return self.wvf, samples
+    
+    def _QNADE_pass(self, N_samples, x, sample, generator, cache=False):
+        
+        layers = self._QNADE_layers()
+        real_modules, imag_modules = layers[0], layers[1]
         
         # a_0, d=0 is set to c (hidden layer bias), and updated on each run. 
         # Expanded to be sample size by L
         a_dr = real_modules[0].bias.expand(N_samples,-1)
         a_di = imag_modules[0].bias.expand(N_samples,-1)
         
-        # the full Psi is a product of the conditionals, making a running product easy
-        PPSI=np.ones([N_samples],dtype=np.complex128) # if multiplying
-        #PPSI=np.zeros([N_samples],dtype=np.complex128)  # if adding logs
+        # the full Psi is a product of the conditionals, so ln(Psi) is a running sum
+        LOG_PPSI=torch.zeros([N_samples],dtype=self.ctype) # adding logs
         
-        # number of outputs we must get for the output layer
-        nevals = len(self.evals)
+        evals = torch.tensor(self.evals, dtype=self.dtype)
+        
+        # preallocated, each site's column is filled in as it is sampled
+        if sample: samples=torch.zeros([N_samples,self.L],dtype=self.dtype)
+        else: 
+            samples=x
+            x_idx=self.eval_index(x) # position in evals of every entered s_i
+        rows=torch.arange(N_samples)
+        
+        if cache: # per site a_d and selected ln(psi_d), see QNADE_pass_partial
+            a_r_cache=torch.zeros((self.L,)+a_dr.shape,dtype=self.dtype)
+            a_i_cache=torch.zeros((self.L,)+a_di.shape,dtype=self.dtype)
+            log_cond=torch.zeros([N_samples,self.L],dtype=self.ctype)
         
         for d in range(self.L):
             
-            # This is the hidden/final layer activation
-            # rough way to test if it is a layer or an activation
-            if not isinstance(real_modules[1], nn.Linear): h_dr, lin_ind_r = real_modules[1](a_dr), 2
-            else: h_dr, lin_ind_r = a_dr, 1
-            if not isinstance(imag_modules[1], nn.Linear): h_di, lin_ind_i = imag_modules[1](a_di), 2
-            else: h_di, lin_ind_i = a_di, 1
-            
-            # Otherwise, the next module is a linear x-form implying no activation
-            # need to ensure the last layer has nevals number of outputs, others are unchanged
-            if last_linear_r==lin_ind_r: d1, d2 = nevals*d, nevals*(d+1)  
-            else: d1, d2 = 0, len(real_modules[lin_ind_r].bias)
-            # initialize the vi_dr (can be x-formed by supplementary layers)
-            vi_dr = h_dr.mm(real_modules[lin_ind_r].weight[d1:d2,:].t())\
-                    +real_modules[lin_ind_r].bias[d1:d2] 
-
-            if last_linear_i==lin_ind_i: d1, d2 = nevals*d, nevals*(d+1)  
-            else: d1, d2 = 0, len(imag_modules[lin_ind_i].bias)
-            vi_di = h_di.mm(imag_modules[lin_ind_i].weight[d1:d2,:].t())\
-                    +imag_modules[lin_ind_i].bias[d1:d2] 
-            
-            # TODO: in paper they use conv layers, adding capability to deal with 
-            # this layer type could improve performance, also could be a way to 
-            # rescale layers as needed (to fit to nevals*L at last layer). 
-            # Calculate the x-formation from visible layer to output layer (v_i)
-            
-            for layer in real_modules[(lin_ind_r+1):len(real_modules)]: 
-            # skip first 2 linear layers (used last to update a_d, vi_d above) & activation (used on h_d above)
-                if isinstance(layer, nn.Linear):
-                    if layer == real_modules[last_linear_r]: d1, d2 = nevals*d, nevals*(d+1)
-                    else:  d1, d2 = 0, len(real_modules[lin_ind_r].bias)
-                    vi_dr = vi_dr.mm(layer.weight[d1:d2,:].t())+layer.bias[d1:d2] 
-                else: vi_dr = layer(vi_dr)
-                                 
-            for layer in imag_modules[(lin_ind_i+1):len(imag_modules)]: 
-                if isinstance(layer, nn.Linear):
-                    if layer == imag_modules[last_linear_r]: d1, d2 = nevals*d, nevals*(d+1)
-                    else:  d1, d2 = 0, len(imag_modules[lin_ind_i].bias)
-                    vi_di = vi_di.mm(layer.weight[d1:d2,:].t())+layer.bias[d1:d2] 
-                else: vi_di = layer(vi_di)            
-            
-            # The Quantum-NADE deviates from a NADE in having a real and imag comp
-            # Here we can use both vi to generate a complex vi that is the 
-            # basis of our calculations and sampling
-            # TODO add form options other than exponential
-            vi = np.exp(vi_dr.detach().numpy()+1j*vi_di.detach().numpy())
-            
-            # TODO create a variable to accumulate the gradients of psi_r (vi_dr)
-            # and psi_i (vi_di) (can be used for full grad)
-#            if grad_required:
-#                    
-#                for n in range(N_samples):
-#                    for j in range(len(self.evals)):
-#                        vi_dr[n,j].backward(retain_graph=True) # takes the mean over the samples
-#                        vi_di[n,j].backward(retain_graph=True)
+            if cache: a_r_cache[d], a_i_cache[d] = a_dr, a_di
             
-            # Normalization and formation of the conditional psi
-            exp_vi=np.exp(vi) # unnorm prob of evals 
-            norm_const=np.sqrt(np.sum(np.power(np.abs(exp_vi),2),1))
-            psi=np.einsum('ij,i->ij', exp_vi, 1/norm_const) 
+            log_psi=self._QNADE_conditional(a_dr, a_di, d, layers)
             
             # Sampling probability is determined by the born rule in QM
             if sample:
-                born_psi=np.power(np.abs(psi),2)
-                assert np.all(np.sum(born_psi,1)-1<1e-6), "Psi not normalized correctly"
-                
-                # sampling routine:
-                probs = born_psi.copy()
-                for ii in range(1, probs.shape[1]): # accumulate prob ranges for easy 
-                    probs[:,ii] = probs[:,ii]+probs[:,ii-1] # sampling with 0<alpha<1
-                
-                a=np.random.rand(N_samples)[:,None]
-                samplepos=np.sum(probs<a,1) # find the sample position in eval list
+                born_psi=torch.exp(2*log_psi.real)
                 
-                # corrected error where sometimes a too large index occurs here
-                # This is a rough fix... But not sure what a better way to ensure it would be
-                if np.any(samplepos==len(self.evals)):
-                    samplepos[samplepos==len(self.evals)] -= 1 
-                
-                xd = torch.tensor(self.evals[samplepos], dtype=self.dtype) # sample
-                if len(xd.shape)==1:
-                    xd = xd[:,None]
-                if d==0:
-                    samples = xd 
-                else:
-                    samples = torch.cat((samples,xd),dim=1) 
+                # categorical draw of the sample position in the eval list
+                samplepos=torch.multinomial(born_psi, 1, generator=generator).squeeze(1)
+                samples[:,d]=evals[samplepos] # sample
+                xd=samples[:,d:d+1]
                 # End sampling routine
             
             else:
                 xd = x[:,d:d+1]
-                if d==0: samples=xd # just checking the iterations
-                else: samples = torch.cat((samples,xd),dim=1) 
                 
                 # find the s_i for psi(s_i), which is to be accumulated for PPSI
-                samplepos = (xd==self.evals[1]).int().numpy().squeeze()
-                # TODO this definitely won't work for non-binary evals, need to
-                # extend functionality to any set of evals
+                samplepos = x_idx[:,d]
             
             # NADE update rule, uses previously sampled x_d
-            a_dr = a_dr + xd.mm(real_modules[0].weight[:,d:(d+1)].t())+real_modules[0].bias
-            a_di = a_di + xd.mm(imag_modules[0].weight[:,d:(d+1)].t())+imag_modules[0].bias
+            a_dr, a_di = self._QNADE_update(a_dr, a_di, xd, d, layers)
 
-            # Multiplicitavely accumulate PPSI based on which sample (s) was sampled
-            PPSI=PPSI*psi[range(N_samples),samplepos]
-            
-            # PPSI may only make sense when inputing an x to get the wvf for...
+            # Accumulate ln(PPSI) based on which sample (s) was sampled
+            LOG_PPSI=LOG_PPSI+log_psi[rows,samplepos]
+            if cache: log_cond[:,d]=log_psi[rows,samplepos]
         
-        self.wvf=PPSI
+        if cache:
+            self.QNADE_cache={'x': samples.clone(), 'a_r': a_r_cache, 'a_i': a_i_cache,
+                'cum_log': torch.cat((torch.zeros([N_samples,1],dtype=self.ctype),\
+                   torch.cumsum(log_cond,1)),1), 'version': self.param_version}
         
-        return PPSI, samples
+        return LOG_PPSI.detach().numpy(), samples
        
         
+    ''' ln(Psi) of configurations x_prime that equal the cached reference sample
+    ref_idx (see QNADE_pass with cache=True) on every site before start, which 
+    defaults to the first site they differ at. The conditionals before start 
+    are read from the cache and the NADE recursion only runs from start on. '''
+    def QNADE_pass_partial(self, x_prime, ref_idx, start=None):
+        
+        cache=self.QNADE_cache
+        x_prime=torch.as_tensor(x_prime,dtype=self.dtype)
+        ref_idx=torch.as_tensor(ref_idx,dtype=torch.long)
+        if start is None:
+            start=torch.argmax((x_prime!=cache['x'][ref_idx]).int(),1)
+        start=torch.as_tensor(start,dtype=torch.long)
+        
+        # sorted by start, the configurations still being recomputed at site d 
+        # are always the leading n_act rows
+        start, order = torch.sort(start)
+        x_prime, ref_idx = x_prime[order], ref_idx[order]
+        x_idx=self.eval_index(x_prime)
+        n_act=torch.searchsorted(start,torch.arange(self.L),right=True).tolist()
+        
+        layers = self._QNADE_layers()
+        with torch.no_grad():
+            LOG_PPSI=cache['cum_log'][ref_idx,start].clone()
+            a_dr=torch.zeros((x_prime.shape[0],)+cache['a_r'].shape[2:],dtype=self.dtype)
+            a_di=torch.zeros((x_prime.shape[0],)+cache['a_i'].shape[2:],dtype=self.dtype)
+            
+            for d in range(int(start[0]) if len(start)>0 else self.L, self.L):
+                # configurations that branch off of their reference at site d
+                new=slice(n_act[d-1] if d>0 else 0, n_act[d])
+                a_dr[new], a_di[new] = cache['a_r'][d,ref_idx[new]], cache['a_i'][d,ref_idx[new]]
+                
+                act=slice(0,n_act[d]) 
+                log_psi=self._QNADE_conditional(a_dr[act], a_di[act], d, layers)
+                
+                xd=x_prime[act,d:d+1]
+                LOG_PPSI[act]+=log_psi[torch.arange(n_act[d]),x_idx[act,d]]
+                
+                a_dr[act], a_di[act] = self._QNADE_update(a_dr[act], a_di[act], xd, d, layers)
+        
+        LOG_PPSI[order]=LOG_PPSI.clone() # back to the order of x_prime
+        return LOG_PPSI.numpy()
+    
+    # The module lists of both networks and the index of their last linear layer
+    def _QNADE_layers(self):
+        
+        real_modules = list(self.real_comp.children())
+        imag_modules = list(self.imag_comp.children())
+                
+        for jj in range(len(real_modules)):
+            if real_modules[jj].__class__.__name__ in self.supported_layers:
+                last_linear_r = jj
+        
+        for jj in range(len(imag_modules)):
+            if imag_modules[jj].__class__.__name__ in self.supported_layers:
+                last_linear_i = jj
+        
+        return real_modules, imag_modules, last_linear_r, last_linear_i
+    
+    # The normalized conditional ln(psi_d) of every eval at site d, given the 
+    # hidden pre-activations a_d of the real and imag networks
+    def _QNADE_conditional(self, a_dr, a_di, d, layers):
+        
+        real_modules, imag_modules, last_linear_r, last_linear_i = layers
+        
+        # number of outputs we must get for the output layer
+        nevals = len(self.evals)
+        
+        # This is the hidden/final layer activation
+        # rough way to test if it is a layer or an activation
+        if not isinstance(real_modules[1], nn.Linear): h_dr, lin_ind_r = real_modules[1](a_dr), 2
+        else: h_dr, lin_ind_r = a_dr, 1
+        if not isinstance(imag_modules[1], nn.Linear): h_di, lin_ind_i = imag_modules[1](a_di), 2
+        else: h_di, lin_ind_i = a_di, 1
+        
+        # Otherwise, the next module is a linear x-form implying no activation
+        # need to ensure the last layer has nevals number of outputs, others are unchanged
+        if last_linear_r==lin_ind_r: d1, d2 = nevals*d, nevals*(d+1)  
+        else: d1, d2 = 0, len(real_modules[lin_ind_r].bias)
+        # initialize the vi_dr (can be x-formed by supplementary layers)
+        vi_dr = h_dr.mm(real_modules[lin_ind_r].weight[d1:d2,:].t())\
+                +real_modules[lin_ind_r].bias[d1:d2] 
+
+        if last_linear_i==lin_ind_i: d1, d2 = nevals*d, nevals*(d+1)  
+        else: d1, d2 = 0, len(imag_modules[lin_ind_i].bias)
+        vi_di = h_di.mm(imag_modules[lin_ind_i].weight[d1:d2,:].t())\
+                +imag_modules[lin_ind_i].bias[d1:d2] 
+        
+        # TODO: in paper they use conv layers, adding capability to deal with 
+        # this layer type could improve performance, also could be a way to 
+        # rescale layers as needed (to fit to nevals*L at last layer). 
+        # Calculate the x-formation from visible layer to output layer (v_i)
+        
+        for layer in real_modules[(lin_ind_r+1):len(real_modules)]: 
+        # skip first 2 linear layers (used last to update a_d, vi_d above) & activation (used on h_d above)
+            if isinstance(layer, nn.Linear):
+                if layer == real_modules[last_linear_r]: d1, d2 = nevals*d, nevals*(d+1)
+                else:  d1, d2 = 0, len(real_modules[lin_ind_r].bias)
+                vi_dr = vi_dr.mm(layer.weight[d1:d2,:].t())+layer.bias[d1:d2] 
+            else: vi_dr = layer(vi_dr)
+                             
+        for layer in imag_modules[(lin_ind_i+1):len(imag_modules)]: 
+            if isinstance(layer, nn.Linear):
+                if layer == imag_modules[last_linear_r]: d1, d2 = nevals*d, nevals*(d+1)
+                else:  d1, d2 = 0, len(imag_modules[lin_ind_i].bias)
+                vi_di = vi_di.mm(layer.weight[d1:d2,:].t())+layer.bias[d1:d2] 
+            else: vi_di = layer(vi_di)            
+        
+        # The Quantum-NADE deviates from a NADE in having a real and imag comp
+        # Here we can use both vi to generate a complex vi that is the 
+        # basis of our calculations and sampling
+        # TODO add form options other than exponential
+        vi = torch.exp(torch.complex(vi_dr, vi_di))
+        
+        # TODO create a variable to accumulate the gradients of psi_r (vi_dr)
+        # and psi_i (vi_di) (can be used for full grad)
+#            if grad_required:
+#                    
+#                for n in range(N_samples):
+#                    for j in range(len(self.evals)):
+#                        vi_dr[n,j].backward(retain_graph=True) # takes the mean over the samples
+#                        vi_di[n,j].backward(retain_graph=True)
+        
+        # Normalization and formation of the conditional ln(psi), exp(vi) is 
+        # the unnorm psi of the evals so ln(norm)=logsumexp(2*Re(vi))/2
+        log_norm=0.5*torch.logsumexp(2*vi.real,1)
+        log_psi=vi-log_norm[:,None]
+        
+        return log_psi
+    
+    # NADE update rule, a_(d+1) from a_d and the (sampled or entered) x_d
+    def _QNADE_update(self, a_dr, a_di, xd, d, layers):
+        
+        real_modules, imag_modules = layers[0], layers[1]
+        a_dr = a_dr + xd.mm(real_modules[0].weight[:,d:(d+1)].t())+real_modules[0].bias
+        a_di = a_di + xd.mm(imag_modules[0].weight[:,d:(d+1)].t())+imag_modules[0].bias
+
+        return a_dr, a_di
+
+    ''' Autoregressive pass of masked (MADE-style) networks. The masks already
+    make the outputs of site d depend only on the sites before it, so for an
+    entered x every conditional comes from one forward pass. Only sampling
+    needs a forward pass per site, as x_d is unknown until it is drawn. '''
+    def _MADE_pass(self, N_samples, x, sample, generator):
+
+        if not sample:
+            log_psi=self._MADE_conditionals(x)
+            LOG_PPSI=torch.gather(log_psi,1,self.eval_index(x)[:,None,:]).sum((1,2))
+            return LOG_PPSI.detach().numpy(), x
+
+        LOG_PPSI=torch.zeros([N_samples],dtype=self.ctype)
+        evals = torch.tensor(self.evals, dtype=self.dtype)
+
+        # sites not yet sampled are left at 0, the masks hide them anyway
+        samples=torch.zeros([N_samples,self.L],dtype=self.dtype)
+        rows=torch.arange(N_samples)
+        for d in self.order:
+            log_psi=self._MADE_conditionals(samples)[:,:,d]
+
+            born_psi=torch.exp(2*log_psi.real)
+            samplepos=torch.multinomial(born_psi, 1, generator=generator).squeeze(1)
+            samples[:,d]=evals[samplepos]
+
+            LOG_PPSI=LOG_PPSI+log_psi[rows,samplepos]
+
+        return LOG_PPSI.detach().numpy(), samples
+
+    # The normalized conditionals ln(psi_d) of every eval and site of x from
+    # one forward pass of each network, shaped [N_samples, nevals, L]
+    def _MADE_conditionals(self, x):
+
+        N_samples=x.shape[0]
+        # output j*L+d of the MADE belongs to eval j of site d
+        vi_dr=self.real_comp(x).view(N_samples,len(self.evals),self.L)
+        if self.re: vi_di=torch.zeros_like(vi_dr)
+        else: vi_di=self.imag_comp(x).view(N_samples,len(self.evals),self.L)
+
+        # v of the form of Psi, the same v autoregressive_grad differentiates
+        vi = self._autoregressive_v(vi_dr, vi_di)[0]
+        log_norm=0.5*torch.logsumexp(2*vi.real,1)
+
+        return vi-log_norm[:,None,:]
+
+def integrated_autocorr_time(x, c=5):
+    ''' Estimates the integrated autocorrelation time tau=1+2*sum_t rho(t) of 
+    the time series x, shaped [n_steps, n_chains]. The autocorrelation rho(t) 
+    is averaged over the chains and the sum is truncated with Sokal's automatic
+    window (the smallest M with M>=c*tau(M)). N_samples/tau is the effective 
+    number of independent samples. A series that never changes (e.g. stuck 
+    chains) gives tau=inf, so N_eff=0. '''
+    
+    x=np.reshape(x,[np.shape(x)[0],-1])
+    n_steps=x.shape[0]
+    if n_steps<2: # no time series to measure
+        return 1.0
+    x=x-np.mean(x,0)
+    if np.all(x==0): # the chains never moved
+        return np.inf
+    
+    # autocovariance of each chain through the FFT (zero padded, no wrap around)
+    f=np.fft.rfft(x,n=2*n_steps,axis=0)
+    acf=np.mean(np.fft.irfft(f*np.conj(f),axis=0)[:n_steps],1)
+    rho=acf/acf[0]
+    
+    taus=2*np.cumsum(rho)-1 # tau(M) for each window size M
+    window=np.arange(n_steps)<c*taus
+    M=np.argmin(window) if not np.all(window) else n_steps-1
+    
+    return max(taus[M],1.0)
+
+'''###################### PSD linear solver ################################'''
+class PSDSolver:
+    ''' Factorizes a symmetric positive (semi-)definite torch matrix A and solves 
+    A x = b, with b a vector or a matrix of right hand sides (K-FAC solves all 
+    the columns of a layer's force at once). A Cholesky factorization is used, 
+    falling back to an eigendecomposition when A is not numerically positive 
+    definite, in which case eigenvalues below cutoff*max(eig) are dropped 
+    (pseudo-inverse). cond, the condition number max|eig|/min|eig| of A, and 
+    rank, the number of eigenvalues above cutoff*max(eig), are only computed 
+    (eigvalsh of A, several times the cost of the Cholesky) when first read. '''
+    def __init__(self, A, cutoff=1e-12):
+        
+        self.cutoff=cutoff
+        self._eig_all=None
+        factor, info = torch.linalg.cholesky_ex(A)
+        if info==0:
+            self.factor=factor
+            self.method='cholesky'
+            self.A=A # kept for the spectrum, only if asked for
+        else:
+            eig, V = torch.linalg.eigh(A)
+            self.method='eigh'
+            self._eig_all=eig
+            keep=eig>cutoff*torch.max(eig)
+            self.eig, self.V = eig[keep], V[:,keep]
+    
+    def _spectrum(self):
+        if self._eig_all is None:
+            self._eig_all=torch.linalg.eigvalsh(self.A)
+        return self._eig_all
+    
+    @property
+    def cond(self):
+        eig=self._spectrum()
+        return (torch.max(torch.abs(eig))/torch.min(torch.abs(eig))).item()
+    
+    @property
+    def rank(self):
+        eig=self._spectrum()
+        return int(torch.sum(eig>self.cutoff*torch.max(eig)))
+    
+    def solve(self, b):
+        
+        vec=(b.dim()==1)
+        if vec: b=b[:,None]
+        if self.method=='cholesky':
+            x=torch.cholesky_solve(b,self.factor)
+        else:
+            x=torch.mm(self.V,torch.mm(self.V.t(),b)/self.eig[:,None])
+        
+        return x[:,0] if vec else x
+
+def conjugate_gradient(A_mv, b, x0=None, tol=1e-8, max_iter=None, M_inv=None):
+    ''' Solves A x = b for a symmetric positive definite A that is only known 
+    through its product A_mv(v)=A.v, by the conjugate gradient method, with 
+    b a 1d torch tensor. M_inv is an optional diagonal preconditioner (the 
+    inverse of diag(A), a 1d tensor, gives the Jacobi preconditioner). Stops 
+    once |A x - b| <= tol*|b| or after max_iter (default 10*len(b)) iterations, 
+    warning if the tolerance was not reached. Returns x and a dict with the 
+    number of iterations 'iter' and the final relative residual 'residual'. '''
+    
+    if max_iter is None: max_iter=10*len(b)
+    if M_inv is None: M_inv=torch.ones_like(b)
+    x=torch.zeros_like(b) if x0 is None else x0.clone()
+    r=b-A_mv(x) if x0 is not None else b.clone()
+    z=M_inv*r
+    p=z.clone()
+    rz=torch.dot(r,z)
+    b_norm=torch.norm(b)
+    
+    n_iter=0
+    while torch.norm(r)>tol*b_norm and n_iter<max_iter:
+        Ap=A_mv(p)
+        alpha=rz/torch.dot(p,Ap)
+        x=x+alpha*p
+        r=r-alpha*Ap
+        z=M_inv*r
+        rz_new=torch.dot(r,z)
+        p=z+(rz_new/rz)*p
+        rz=rz_new
+        n_iter+=1
+    
+    residual=(torch.norm(r)/b_norm).item() if b_norm>0 else 0.0
+    if residual>tol:
+        warnings.warn('conjugate_gradient did not converge, relative residual '\
+                      +str(residual)+' after '+str(n_iter)+' iterations')
+    
+    return x, {'iter': n_iter, 'residual': residual}
+
 def kron_matrix_gen(op_list,D,N,bc):
     ''' this function generates a Hamiltonian when it consists of a sum
  of local operators. The local operator should be input at op and the 
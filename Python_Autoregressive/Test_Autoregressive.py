@@ -7,7 +7,7 @@ Created on Wed Jun 24 16:15:18 2020
 """
 
 import numpy as np
-from autograd_hacks_master import autograd_hacks
+import autograd_hacks
 import matplotlib.pyplot as plt
 import torch
 from NQS_pytorch import Psi, Op, kron_matrix_gen
@@ -1092,6 +1092,9 @@ for rr in range(len(pars)):
     print(p_r[rr].grad-torch.tensor(np.real(E_grad_re[rr]),dtype=torch.float).squeeze())
     print(p_i[rr].grad-torch.tensor(np.real(E_grad_im[rr]),dtype=torch.float).squeeze())
 
+# the per sample O_k of autoregressive_Ok, and the gradient of every form, are 
+# checked in Test_QNADE_sampling.py
+
 '''##### Finally, optimize by combining sampling and gradient descent  #####'''
 
 ppsi=psi_init(L,hidden_layer_sizes,nout,'exponential')
@@ -14,7 +14,7 @@ Section 8: tests optimization routine
 """
 
 import numpy as np
-from autograd_hacks_master import autograd_hacks
+import autograd_hacks
 import matplotlib.pyplot as plt
 import torch
 from NQS_pytorch import Psi, Op, kron_matrix_gen
@@ -9,7 +9,7 @@ Created on Tue May 12 14:42:29 2020
 import torch
 import torch.nn as nn
 import numpy as np
-from NQS_pytorch import Op, Psi, kron_matrix_gen
+from NQS_pytorch import Op, Psi, Hamiltonian, kron_matrix_gen
 import itertools
 
 '''
@@ -124,3 +124,27 @@ O_loc_analytic= np.sum(np.matmul((np.abs(wvf.T)**2),(H_sxsx_ex+H_sx_ex)))\
 print('\n\n Energy using O_local in the analytical expression: ',O_loc_analytic, \
       '\n vs. that calculated with matrices: ', E_exact )
 
+
+''' Checking the batched O_local and the sparse (nonzero element) evaluation '''
+
+H_sxsx_b=ppsi.O_local(sxsx,s,batched=True,chunk_size=100)
+H_nn_b=ppsi.O_local(nn_interaction,s,batched=True) # diagonal, no s' evaluated
+H_nn_ex=ppsi.O_local(nn_interaction,s)
+
+print('\n\n Max difference of batched vs per site O_local: ', \
+      np.max(np.abs(H_sxsx_b-H_sxsx_ex)), ' ', np.max(np.abs(H_nn_b-H_nn_ex)))
+
+''' Sz*Sz is diagonal, so O_local is -J*sz_i*sz_(i+1) for each sample '''
+
+szsz_exact=-J*s*np.roll(s,-1,axis=1)
+print('\n Max difference of diagonal O_local vs -J*sz*sz: ', \
+      np.max(np.abs(H_nn_ex-szsz_exact)))
+
+''' Fused local energy of the Hamiltonian container vs summed O_local terms '''
+
+hamiltonian=Hamiltonian([sxsx, b_field])
+E_loc, [H_sxsx_h, H_sx_h] = hamiltonian.local_energy(ppsi,s,per_term=True)
+
+print('\n Max difference of fused vs separate local energy: ', \
+      np.max(np.abs(E_loc-np.sum(H_sxsx_ex+H_sx_ex,axis=1))), '\n per term: ', \
+      np.max(np.abs(H_sxsx_h-H_sxsx_ex)), ' ', np.max(np.abs(H_sx_h-H_sx_ex)))
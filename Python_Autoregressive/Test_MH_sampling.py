@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Testing the Metropolis Hastings sampler with many parallel chains. The sample 
+distribution is compared to |Psi(s)|^2 for a system small enough to enumerate.
+
+@author: Alex Lidiak
+"""
+
+import time
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+from NQS_pytorch import Psi
+
+L = 6 # system size
+datatype=torch.double
+
+spin=0.5
+evals=2*np.arange(-spin,spin+1)
+s2=np.array(list(itertools.product(evals,repeat=L)))
+
+H=2*L
+real_net=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,1), nn.Sigmoid())
+imag_net=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,1,bias=False))
+
+ppsi=Psi(real_net,imag_net, L, form='euler',dtype=datatype)
+
+wvf=ppsi.complex_out(torch.tensor(s2,dtype=datatype)).squeeze()
+probs=np.abs(wvf)**2/np.sum(np.abs(wvf)**2)
+
+# histogram of the samples over the s2 configurations
+def sample_hist(s):
+    ind=np.sum((s==evals[-1])*(2**np.arange(L-1,-1,-1)),1) # s2 index of each sample
+    return np.bincount(ind,minlength=len(s2))/s.shape[0]
+
+'''############ Single chain vs many parallel chains ########################'''
+N_samples=50000
+burn_in=1000
+
+for n_chains in [1, 100]:
+    start=time.time()
+    s=ppsi.sample_MH(N_samples+burn_in*n_chains,spin=0.5,n_chains=n_chains)
+    end=time.time()
+    
+    s=s[burn_in*n_chains:] # rows are ordered by step, so this drops the burn in 
+    h=sample_hist(s)
+    
+    print('\n n_chains=', n_chains, ' samples shape: ', s.shape, ' time: ', end-start, \
+          '\n max abs error of sample distribution vs |Psi|^2: ', np.max(np.abs(h-probs)), \
+          ' (max |Psi|^2= ', np.max(probs), ')')
+
+'''###### Burn in, thinning and sweeps vs the autocorrelation time ##########'''
+# single proposals are highly correlated, sweeps (L proposals per sample) and 
+# thinning should bring tau close to 1 and N_eff close to N_samples
+n_chains=100
+for kwargs in [dict(), dict(thin=3), dict(sweep=True)]:
+    s, tau = ppsi.sample_MH(N_samples,spin=0.5,n_chains=n_chains,burn_in=100, \
+                            return_tau=True, **kwargs)
+    h=sample_hist(s)
+    print('\n', kwargs, ' tau: ', tau, ' N_eff: ', ppsi.N_eff, ' of ', s.shape[0], \
+          '\n max abs error of sample distribution vs |Psi|^2: ', np.max(np.abs(h-probs)))
+
+'''########### Persistent chains, warm starting from the last call ##########'''
+s=ppsi.sample_MH(N_samples,spin=0.5,n_chains=n_chains,burn_in=100,sweep=True)
+last_states=ppsi.chain_state.copy()
+
+start=time.time()
+s=ppsi.sample_MH(N_samples,spin=0.5,n_chains=n_chains,sweep=True,warm_start=True)
+end=time.time()
+
+print('\n Warm started chains continue from the previous states: ', \
+      np.all(s[:n_chains]==last_states), ' time: ', end-start, \
+      '\n max abs error of sample distribution vs |Psi|^2: ', np.max(np.abs(sample_hist(s)-probs)))
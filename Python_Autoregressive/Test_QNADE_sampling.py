@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Testing the Psi.QNADE_pass autoregressive sampling and Psi evaluation. The 
+exact samples are compared to |Psi(s)|^2 for a system small enough to enumerate.
+
+@author: Alex Lidiak
+"""
+
+import time
+import copy
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+from NQS_pytorch import Psi
+
+L = 6 # system size
+datatype=torch.double
+
+spin=0.5
+evals=2*np.arange(-spin,spin+1)
+s2=np.array(list(itertools.product(evals,repeat=L)))
+
+H=2*L
+autoreg_real_net=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,len(evals)*L))
+autoreg_imag_net=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,len(evals)*L))
+
+ppsi = Psi(autoreg_real_net, autoreg_imag_net, L, form='exponential', dtype=datatype, autoregressive=True)
+
+wvf, _ = ppsi.QNADE_pass(x=torch.tensor(s2,dtype=datatype))
+probs=np.abs(wvf)**2
+
+print('Autoregressive Psi normalization (should be 1): ', np.sum(probs))
+
+# histogram of the samples over the s2 configurations
+def sample_hist(s):
+    ind=np.sum((s==evals[-1])*(2**np.arange(L-1,-1,-1)),1) # s2 index of each sample
+    return np.bincount(ind,minlength=len(s2))/s.shape[0]
+
+'''############### Exact sampling vs |Psi|^2 and seeding ####################'''
+N_samples=int(1e+5)
+
+start=time.time()
+_, s = ppsi.QNADE_pass(N_samples, generator=1234)
+end=time.time()
+
+print('\n Sampling time: ', end-start, '\n max abs error of sample distribution'\
+      ' vs |Psi|^2: ', np.max(np.abs(sample_hist(s.numpy())-probs)), \
+      ' (max |Psi|^2= ', np.max(probs), ')')
+
+_, s_seed = ppsi.QNADE_pass(N_samples, generator=torch.Generator().manual_seed(1234))
+print('\n Same seed gives the same samples: ', torch.equal(s,s_seed))
+
+'''######## ln(Psi) accumulation for systems where Psi underflows ###########'''
+L_large=500
+real_net_large=nn.Sequential(nn.Linear(L_large,H), nn.Sigmoid(), nn.Linear(H,len(evals)*L_large))
+imag_net_large=nn.Sequential(nn.Linear(L_large,H), nn.Sigmoid(), nn.Linear(H,len(evals)*L_large))
+ppsi_large = Psi(real_net_large, imag_net_large, L_large, form='exponential', \
+                 dtype=datatype, autoregressive=True)
+
+log_wvf, s_large = ppsi_large.QNADE_pass(1000, return_log=True)
+log_wvf_x, _ = ppsi_large.QNADE_pass(x=s_large, return_log=True)
+
+print('\n L=', L_large, ' ln|Psi| of the samples: ', np.real(log_wvf[:3]), \
+      '\n finite: ', np.all(np.isfinite(log_wvf)), ', evaluation matches sampling: ', \
+      np.allclose(log_wvf, log_wvf_x))
+
+'''###### Cached pass over s reused for the s' connected by an operator #####'''
+from NQS_pytorch import Op
+sigmax=np.array([[0,1],[1,0]])
+b_field=Op(sigmax)
+for i in range(L_large):
+    b_field.add_site([i])
+
+_, s_large = ppsi_large.QNADE_pass(100)
+ppsi_large.log_psi(s_large, cache=True)
+_, n_idx, _, s_primes, _ = b_field.connected(s_large.numpy(), evals)
+
+start=time.time()
+log_psi_partial=ppsi_large.QNADE_pass_partial(s_primes, n_idx)
+t_partial=time.time()-start
+start=time.time()
+log_psi_full=ppsi_large.log_psi_chunked(s_primes)
+t_full=time.time()-start
+
+print('\n Partial pass matches the full pass over s\': ', \
+      np.allclose(log_psi_partial, log_psi_full), '\n time partial: ', t_partial, \
+      ' time full: ', t_full)
+
+# O_local with and without the cache, which is not kept after the call
+O_cached=ppsi_large.O_local(b_field, s_large.numpy(), batched=True)
+ppsi_large.use_QNADE_cache=False
+O_uncached=ppsi_large.O_local(b_field, s_large.numpy(), batched=True)
+ppsi_large.use_QNADE_cache=True
+
+print(' O_local cached vs full passes: ', np.allclose(O_cached, O_uncached), \
+      ' cache released: ', ppsi_large.QNADE_cache is None)
+
+'''############ Spin-1 (3 evals) through the same sampling path #############'''
+evals1=2*np.arange(-1,1+1)
+s3=np.array(list(itertools.product(evals1,repeat=L)))
+
+real_net_s1=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,len(evals1)*L))
+imag_net_s1=nn.Sequential(nn.Linear(L,H), nn.Sigmoid(), nn.Linear(H,len(evals1)*L))
+ppsi_s1 = Psi(real_net_s1, imag_net_s1, L, evals=evals1, form='exponential', \
+              dtype=datatype, autoregressive=True)
+
+wvf_s1, _ = ppsi_s1.QNADE_pass(x=torch.tensor(s3,dtype=datatype))
+probs_s1=np.abs(wvf_s1)**2
+
+_, s = ppsi_s1.QNADE_pass(N_samples, generator=1234)
+ind=np.sum(ppsi_s1.eval_index(s).numpy()*(len(evals1)**np.arange(L-1,-1,-1)),1)
+hist_s1=np.bincount(ind,minlength=len(s3))/N_samples
+
+print('\n Spin-1 normalization (should be 1): ', np.sum(probs_s1), \
+      '\n max abs error of sample distribution vs |Psi|^2: ', \
+      np.max(np.abs(hist_s1-probs_s1)), ' (max |Psi|^2= ', np.max(probs_s1), ')')
+
+'''###### Masked (MADE) networks, all conditionals in one forward pass #######'''
+from made import MADE
+made_real_net=MADE(L, [H], len(evals)*L, num_masks=1, natural_ordering=False)
+made_imag_net=MADE(L, [H], len(evals)*L, num_masks=1, natural_ordering=False)
+made_imag_net.m[-1]=made_real_net.m[-1] # both nets need the same ordering
+made_imag_net.update_masks()
+ppsi_made = Psi(made_real_net, made_imag_net, L, form='exponential', \
+                dtype=datatype, autoregressive=True)
+
+start=time.time()
+wvf_made, _ = ppsi_made.QNADE_pass(x=torch.tensor(s2,dtype=datatype))
+t_single=time.time()-start
+probs_made=np.abs(wvf_made)**2
+
+# reference: one forward pass per site, as in QNADE_pass2, with only the sites 
+# before d (in the MADE ordering) entered and the conditional built in numpy
+start=time.time()
+wvf_loop=np.ones(len(s2),dtype=complex)
+for k, d in enumerate(ppsi_made.order):
+    x_masked=s2.copy()
+    x_masked[:,ppsi_made.order[k:]]=0
+    x_masked=torch.tensor(x_masked,dtype=datatype)
+    # outputs j*L+d of the MADE belong to site d
+    vi_dr=made_real_net(x_masked)[:,d::L].detach().numpy()
+    vi_di=made_imag_net(x_masked)[:,d::L].detach().numpy()
+    exp_vi=np.exp(np.exp(vi_dr+1j*vi_di)) # exponential form
+    psi_d=exp_vi/np.sqrt(np.sum(np.abs(exp_vi)**2,1))[:,None]
+    wvf_loop*=psi_d[np.arange(len(s2)),np.argmax(s2[:,d][:,None]==evals[None,:],1)]
+t_loop=time.time()-start
+
+_, s = ppsi_made.QNADE_pass(N_samples, generator=1234)
+
+print('\n MADE normalization (should be 1): ', np.sum(probs_made), \
+      '\n single pass matches per site passes: ', np.allclose(wvf_made,\
+      wvf_loop), '\n time single: ', t_single, ' time per site: ', t_loop, \
+      '\n max abs error of sample distribution vs |Psi|^2: ', \
+      np.max(np.abs(sample_hist(s.numpy())-probs_made)), ' (max |Psi|^2= ', \
+      np.max(probs_made), ')')
+
+# per sample O_k=Re(dln(Psi)/dw) of autoregressive_Ok (one backward pass) vs 
+# autograd of ln|Psi(s_n)| of a few samples, one at a time
+s_made=s[:5].to(datatype)
+Ok_made=ppsi_made.autoregressive_Ok(s_made, evals, 'real')
+Ok_err=0
+for n in range(s_made.shape[0]):
+    ppsi_made.real_comp.zero_grad()
+    log_psi=ppsi_made._MADE_conditionals(s_made[n:n+1])
+    torch.gather(log_psi,1,ppsi_made.eval_index(s_made[n:n+1])[:,None,:]).sum().real.backward()
+    Ok_err=max([Ok_err]+[torch.max(torch.abs(Ok[n]-param.grad)).item() \
+               for Ok, param in zip(Ok_made, ppsi_made.real_comp.parameters())])
+
+# and their E_arg weighted mean is the energy gradient of autoregressive_grad
+E_loc_made=np.random.randn(s_made.shape[0])
+ppsi_made.autoregressive_grad(E_loc_made, s_made, evals, 'real')
+E_mult=torch.tensor(2*(E_loc_made-np.mean(E_loc_made)),dtype=datatype)
+grad_err=max([torch.max(torch.abs(torch.einsum('i,i...->...',E_mult,Ok)/s_made.shape[0]\
+              -param.grad)).item() for Ok, param in zip(Ok_made, ppsi_made.real_comp.parameters())])
+
+print('\n max error of the per sample O_k: ', Ok_err, \
+      '\n max error of their weighted mean vs autoregressive_grad: ', grad_err)
+
+# every form against autograd of the E_arg weighted ln|Psi(s)| of the same nets
+for form in ['exponential','euler','vector','real']:
+    ppsi_f=Psi(copy.deepcopy(made_real_net), copy.deepcopy(made_imag_net), L, \
+               form=form, dtype=datatype, autoregressive=True)
+    ppsi_f.autoregressive_grad(E_loc_made, s_made, evals, 'real')
+    grad_f=[param.grad.clone() for param in ppsi_f.real_comp.parameters()]
+    
+    ppsi_f.real_comp.zero_grad()
+    log_psi=ppsi_f._MADE_conditionals(s_made)
+    log_psi_s=torch.gather(log_psi,1,ppsi_f.eval_index(s_made)[:,None,:]).sum((1,2))
+    (E_mult*log_psi_s.real).mean().backward()
+    
+    print(form, ' max grad error: ', max([torch.max(torch.abs(g-param.grad)).item() \
+          for g, param in zip(grad_f, ppsi_f.real_comp.parameters())]))
@@ -93,9 +93,7 @@ def SR(ppsi,s,E_loc, E0=None, lambduh=1):#, cutoff=1e-8):
     N_samples=s.shape[0]
     
     if ppsi.form.lower()=='vector':
-        if np.all(ppsi.complex==0): 
-            ppsi.complex_out(s)
-        m_r=(1/ppsi.complex).squeeze()
+        m_r=(1/ppsi.complex_out(s)).squeeze()
         m_i=1j*m_r
     elif ppsi.form.lower()=='euler' or ppsi.form.lower()=='exponential'\
          or ppsi.form.lower()=='real':
@@ -193,6 +191,126 @@ def SR(ppsi,s,E_loc, E0=None, lambduh=1):#, cutoff=1e-8):
 #    
 #    return
 
+'''###### Matrix free conjugate gradient SR vs the dense factorization ######'''
+
+def SR_update(ppsi):
+    pars=list(ppsi.real_comp.parameters())+list(ppsi.imag_comp.parameters())
+    return [param.grad.clone() for param in pars]
+
+start=time.time()
+ppsi.SR(s,E_loc,lambduh)
+t_chol=time.time()-start
+grad_chol=SR_update(ppsi)
+print('condition number and rank of each S block: ', [sol.cond for sol in \
+      ppsi.SR_solvers], [sol.rank for sol in ppsi.SR_solvers])
+
+start=time.time()
+ppsi.SR(s,E_loc,lambduh,solver='cg')
+t_cg=time.time()-start
+grad_cg=SR_update(ppsi)
+
+print('max difference of the cg and Cholesky SR updates: ', max([torch.max(\
+      torch.abs(g1-g2)).item() for g1, g2 in zip(grad_chol,grad_cg)]), \
+      '\n time Cholesky: ', t_chol, ' time cg: ', t_cg)
+
+# the O_k matrix stored by compute_Ok is used, then released, by the next SR on s
+ppsi.compute_Ok(s)
+start=time.time()
+ppsi.SR(s,E_loc,lambduh,structure='full')
+print('\n coupled (full S) SR from the stored O_k, time: ', time.time()-start, \
+      '\n |F|: ', ppsi.SR_info['force_norm'], ' |update|: ', ppsi.SR_info['update_norm'], \
+      '\n O_k released: ', ppsi.Ok_cache is None)
+
+# more parameters than samples, the dense solve moves to the sample space
+H_big=200
+ppsi_big=Psi(nn.Sequential(nn.Linear(L,H_big),nn.Tanh(),nn.Linear(H_big,1)), \
+    nn.Sequential(nn.Linear(L,H_big),nn.Tanh(),nn.Linear(H_big,1)), L, form='exponential', \
+    dtype='double') # S is badly conditioned, double precision to compare the solvers
+s_small=s[:100].double()
+E_loc_small=np.sum(ppsi_big.O_local(nn_interaction,s_small.numpy())+\
+                   ppsi_big.O_local(b_field,s_small.numpy()),axis=1)
+
+start=time.time()
+ppsi_big.SR(s_small,E_loc_small,lambduh,structure='full')
+t_samples=time.time()-start
+grad_samples=SR_update(ppsi_big)
+ppsi_big.SR(s_small,E_loc_small,lambduh,solver='cg',cg_tol=1e-12,structure='full')
+grad_cg=SR_update(ppsi_big)
+print('\n cg iterations and relative residual: ', ppsi_big.SR_info['cg_iter'], \
+      ppsi_big.SR_info['cg_residual'])
+
+def rel_diff(grad1, grad2):
+    g1, g2 = torch.cat([g.flatten() for g in grad1]), torch.cat([g.flatten() for g in grad2])
+    return (torch.norm(g1-g2)/torch.norm(g2)).item()
+
+print('\n sample space SR vs parameter space cg, relative difference: ', \
+      rel_diff(grad_samples,grad_cg), '\n time sample space: ', t_samples)
+
+# the same full S solve from the activations and backprops only (no O_k or S)
+start=time.time()
+ppsi_big.SR(s_small,E_loc_small,lambduh,solver='matrix_free',cg_tol=1e-12)
+t_free=time.time()-start
+grad_free=SR_update(ppsi_big)
+
+print('\n matrix free SR vs O_k cg, relative difference: ', rel_diff(grad_free,grad_cg), \
+      '\n time matrix free: ', t_free, ' cg iterations: ', ppsi_big.SR_info['cg_iter'])
+
+# K-FAC on a fresh set of factors vs the dense solve of the same per layer 
+# system, (A_f+gamma I) x (B_f+gamma I) vec(X) = vec(F) with gamma=sqrt(lambduh), 
+# from factors built here without autograd_hacks: A_f=<[a,1][a,1]^T> over the 
+# layer inputs a and B_f=<2|m|^2 b b^T> over the per sample d(out)/d(pre-act) b, 
+# i.e. the uncentered S of each layer, and F the force from the O_k matrix
+lambduh_kfac=1e-3
+ppsi_big.KFAC_factors={}
+start=time.time()
+ppsi_big.KFAC(s_small,E_loc_small,lambduh=lambduh_kfac)
+t_kfac=time.time()-start
+grad_kfac=SR_update(ppsi_big)
+
+E_arg_small=np.conj(E_loc_small)-np.conj(np.mean(np.real(E_loc_small)))
+force=ppsi_big.Ok_force(ppsi_big.compute_Ok(s_small),E_arg_small)
+gamma=np.sqrt(lambduh_kfac)
+grad_ref=[]
+for net in [ppsi_big.real_comp, ppsi_big.imag_comp]: # 2|m|^2=2 in exponential form
+    z1=net[0](s_small); z2=net[2](net[1](z1))
+    b1, b2 = torch.autograd.grad(z2.sum(),[z1,z2])
+    for layer, a, b in [(net[0],s_small,b1), (net[2],net[1](z1),b2)]:
+        a=torch.cat((a.detach(),torch.ones([a.shape[0],1],dtype=a.dtype)),1)
+        A_f=torch.mm(a.t(),a)/a.shape[0]+gamma*torch.eye(a.shape[1],dtype=a.dtype)
+        B_f=2*torch.mm(b.t(),b)/b.shape[0]+gamma*torch.eye(b.shape[1],dtype=b.dtype)
+        
+        n_w, n_b = layer.weight.numel(), layer.bias.numel()
+        F=torch.cat((force[:n_w].view(layer.weight.shape),force[n_w:n_w+n_b,None]),1)
+        force=force[n_w+n_b:]
+        # column major vec(B X A)=(A x B) vec(X), both factors symmetric
+        X=torch.linalg.solve(torch.kron(A_f,B_f),F.t().flatten()).view(F.t().shape).t()
+        grad_ref+=[X[:,:-1], X[:,-1]]
+
+kfac_err=rel_diff(grad_kfac,grad_ref)
+print('\n K-FAC vs the dense solve of the same factors, relative difference: ', \
+      kfac_err, '\n time K-FAC: ', t_kfac, ' condition numbers of the factors: ', \
+      [sol.cond for sol in ppsi_big.KFAC_solvers])
+assert kfac_err<1e-8, 'K-FAC update does not match the dense per layer solve'
+
+# options that SR would ignore are refused rather than silently dropped
+for kwargs in [{'solver':'matrix_free','structure':'layer'}, {'solver':'cg','structure':'diag'}, \
+               {'solver':'cholesky','cg_tol':1e-12}]:
+    try:
+        ppsi_big.SR(s_small,E_loc_small,lambduh,**kwargs)
+        print(kwargs, ' was not refused')
+    except ValueError as err:
+        print(kwargs, ' refused: ', *err.args)
+
+# cheaper S approximations on the same O_k, from diag(S) only up to the full S
+grad_full=torch.cat([g.flatten() for g in grad_cg])
+for structure in ['diag','param','layer','full']:
+    start=time.time()
+    ppsi_big.SR(s_small,E_loc_small,lambduh,structure=structure)
+    t_struct=time.time()-start
+    grad_struct=torch.cat([g.flatten() for g in SR_update(ppsi_big)])
+    print('\n', structure, 'S, cosine with the full SR update: ', (torch.dot(grad_struct,\
+          grad_full)/(torch.norm(grad_struct)*torch.norm(grad_full))).item(), ' time: ', t_struct)
+
 ''' ############### Explicit Testing of the SR func ####################### '''
 
 ppsi=psi_init(L,L,'euler')  # without mult, initializes params randomly
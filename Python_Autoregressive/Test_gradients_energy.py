@@ -20,7 +20,7 @@ import torch.nn as nn
 import numpy as np
 from NQS_pytorch import Op, Psi, kron_matrix_gen
 import itertools
-from autograd_hacks_master import autograd_hacks
+import autograd_hacks
 import time
 
 # system parameters
@@ -455,4 +455,25 @@ Ok=np.squeeze(Ok)
 deriv_E0=Exp_val(np.conj(Ok)*E_loc,wvf0)+Exp_val(Ok*np.conj(E_loc),wvf0)-\
 Exp_val(E_loc,wvf0)*(Exp_val(np.conj(Ok),wvf0)+Exp_val(Ok,wvf0))
 
-print('\n Expecation val deriv: ', deriv_E0, '\n vs numerical wvf energy diff: ', dif)
\ No newline at end of file
+print('\n Expecation val deriv: ', deriv_E0, '\n vs numerical wvf energy diff: ', dif)
+
+''' ###### Weighted per layer contraction vs the stored O_k matrix ###### '''
+
+def all_grads(ppsi):
+    pars=list(ppsi.real_comp.parameters())+list(ppsi.imag_comp.parameters())
+    return [param.grad.clone() for param in pars]
+
+# E_loc above is over the exact basis s2, the local energies of the samples s
+E_loc_s=np.sum(ppsi_mod.O_local(nn_interaction,s.numpy())+\
+               ppsi_mod.O_local(b_field,s.numpy()),axis=1)
+
+# no O_k stored for s and the current params, uses autograd_hacks.compute_weighted_grad
+ppsi_mod.energy_gradient(s,E_loc_s)
+grad_weighted=all_grads(ppsi_mod)
+
+ppsi_mod.compute_Ok(s) # the O_k matrix is now reused for the same s
+ppsi_mod.energy_gradient(s,E_loc_s)
+grad_Ok=all_grads(ppsi_mod)
+
+print('max difference of the weighted and O_k energy gradients: ', max([torch.max(\
+      torch.abs(g1-g2)).item() for g1, g2 in zip(grad_weighted,grad_Ok)]))
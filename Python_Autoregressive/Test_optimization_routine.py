@@ -89,8 +89,15 @@ ppsi=Psi(real_net,imag_net, L, form='euler',dtype=datatype)
 # Enter simulation hyper parameters
 N_iter=300
 N_samples=10000
-burn_in=1000
+burn_in=100 # burn in sweeps (L proposals each) per chain, first iteration only
+re_equil=5 # sweeps to re-equilibrate the persistent chains each iteration
+n_chains=100 # number of parallel Markov chains
 lr=0.1
+# by default the SR grad is applied as plain param-=lr*grad with the hand 
+# decayed lr below, use_optimizer=True applies it by torch.optim SGD with 
+# momentum and an exponential lr schedule instead (see set_optimizer)
+use_optimizer=False
+checkpoint=None # file name to torch.save the nets and optimizer state to
 real_time_plot=True
 exact_energy=True
 
@@ -101,6 +108,10 @@ lambduh0, b, lambduh_min = 100, 0.95, 1e-4
 s=np.random.randint(-1,high=1,size=[N_samples,L]); s[s==0]=1; 
 s=torch.tensor(s,dtype=datatype)
 
+if use_optimizer:
+    ppsi.set_optimizer(torch.optim.SGD, lr=lr, momentum=0.9, scheduler=\
+        lambda opt: torch.optim.lr_scheduler.ExponentialLR(opt,0.99))
+
 if real_time_plot:
     plt.figure()
     plt.axis([0, N_iter, min_E-0.5, L])
@@ -109,13 +120,14 @@ if real_time_plot:
 energy_n=np.zeros([N_iter,1])
 for n in range(N_iter):
     
-    # before doing the actual sampling, we should do a burn in
-    sb=ppsi.sample_MH(burn_in,spin=0.5)
-    
     start = time.time()
-    # Now we sample from the state and recast this as the new s, s0 so burn in is used
-    s=torch.tensor(ppsi.sample_MH(N_samples,spin=0.5, s0=sb[-1]),dtype=datatype)
-    end = time.time(); print(end - start) # MC Sampling is the real bottleneck
+    # Sample a sweep apart after the burn in sweeps, tau is the autocorrelation 
+    # time of the chains (in samples) and N_eff the effective sample size. 
+    # After the first iteration the chains continue from the previous one.
+    s,tau=ppsi.sample_MH(N_samples,spin=0.5, n_chains=n_chains, sweep=True, \
+        burn_in=(burn_in if n==0 else re_equil), warm_start=True, return_tau=True)
+    s=torch.tensor(s,dtype=datatype)
+    end = time.time(); print(end - start, ' tau: ', tau, ' N_eff: ', ppsi.N_eff)
     
     if exact_energy and L<=14: # if want to test the energy without sampling
         wvf=ppsi.complex_out(s2)
@@ -125,12 +137,16 @@ for n in range(N_iter):
         s=s2
         # Need sampling, as s2 will have low prob states of Psi disproportionately represented
         # Get the energy at each iteration
-        [H_nn, H_b]=ppsi.O_local(nn_interaction,s.numpy()),ppsi.O_local(b_field,s.numpy())
+        log_psi_s=ppsi.log_psi(s) # psi(s) is shared by both operators
+        [H_nn, H_b]=ppsi.O_local(nn_interaction,s.numpy(),log_psi_s,batched=True),\
+            ppsi.O_local(b_field,s.numpy(),log_psi_s,batched=True)
         energy_per_sample = np.sum(H_nn+H_b,axis=1)
         energy_n[n]=E_tot
     else:
         # Get the energy at each iteration
-        [H_nn, H_b]=ppsi.O_local(nn_interaction,s.numpy()),ppsi.O_local(b_field,s.numpy())
+        log_psi_s=ppsi.log_psi(s) # psi(s) is shared by both operators
+        [H_nn, H_b]=ppsi.O_local(nn_interaction,s.numpy(),log_psi_s,batched=True),\
+            ppsi.O_local(b_field,s.numpy(),log_psi_s,batched=True)
         energy_per_sample=np.sum(H_nn+H_b,axis=1)
         energy_n[n] = np.real(np.mean(energy_per_sample))
     
@@ -139,7 +155,7 @@ for n in range(N_iter):
     l_iter=max(lambduh0*b**(n),lambduh_min)
     ppsi.SR(s,energy_per_sample, lambduh=l_iter)#, cutoff=1e-8)
     
-    lr=lr*0.99
+    if not use_optimizer: lr=lr*0.99
     ppsi.apply_grad(lr) # releases/updates parameters based on grad method (stored in pars.grad)
 
     if n%10==0:
@@ -151,6 +167,9 @@ for n in range(N_iter):
             plt.pause(0.05)
             plt.draw()
 
+if checkpoint is not None:
+    torch.save(ppsi.state_dict(),checkpoint) # resume with ppsi.load_state_dict
+
 if not real_time_plot:
     plt.figure()
     if L<=14:
@@ -180,6 +180,201 @@ def compute_grad1(model: nn.Module, loss_type: str = 'mean') -> None:
                 setattr(layer.bias, 'grad1', torch.sum(B, dim=2))
 
 
+def compute_weighted_grad(model: nn.Module, weights: torch.Tensor, loss_type: str = 'mean') -> None:
+    """
+    Compute the weighted sum of per-example gradients sum_n weights[n]*grad1[n] and save it under
+    'param.weighted_grad'. Must be called after loss.backprop(). The sum is contracted directly from
+    the activations and backprops (a single matmul per layer), so the [n, ...] grad1 tensors are never
+    formed and memory stays O(#params) instead of O(n*#params).
+
+    Args:
+        model:
+        weights: per-example weights, shaped [n]
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+    """
+
+    assert loss_type in ('sum', 'mean')
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_backprops(layer, loss_type)
+        n = A.shape[0]
+        w = weights.to(B.dtype)
+
+        if layer_type == 'Linear' or layer_type == 'MaskedLinear':
+            grad = torch.mm((w[:, None] * B).t(), A)
+            if layer_type == 'MaskedLinear':  # same mask as in compute_grad1
+                grad = grad * layer.mask
+            setattr(layer.weight, 'weighted_grad', grad)
+            if layer.bias is not None:
+                setattr(layer.bias, 'weighted_grad', torch.mv(B.t(), w))
+
+        elif layer_type == 'Conv2d':
+            A = torch.nn.functional.unfold(A, layer.kernel_size)
+            B = B.reshape(n, -1, A.shape[-1])
+            grad = torch.einsum('i,ijk,ilk->jl', w, B, A)
+            setattr(layer.weight, 'weighted_grad', grad.reshape(layer.weight.shape))
+            if layer.bias is not None:
+                setattr(layer.bias, 'weighted_grad', torch.einsum('i,ijk->j', w, B))
+
+
+def compute_weighted_sq_grad(model: nn.Module, weights: torch.Tensor, loss_type: str = 'mean') -> None:
+    """
+    Compute the weighted sum of squared per-example gradients sum_n weights[n]*grad1[n]**2 and save it
+    under 'param.weighted_sq_grad'. For Linear and MaskedLinear layers grad1[n] is the outer product of
+    B[n] and A[n], so its square is contracted as (weights*B**2)^T A**2 without forming grad1. Conv2d
+    per-example gradients do not factorize this way and are formed one layer at a time.
+
+    Args:
+        model:
+        weights: per-example weights, shaped [n]
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+    """
+
+    assert loss_type in ('sum', 'mean')
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_backprops(layer, loss_type)
+        w = weights.to(B.dtype)
+
+        if layer_type == 'Linear' or layer_type == 'MaskedLinear':
+            grad = torch.mm((w[:, None] * B**2).t(), A**2)
+            if layer_type == 'MaskedLinear':
+                grad = grad * layer.mask
+            setattr(layer.weight, 'weighted_sq_grad', grad)
+            if layer.bias is not None:
+                setattr(layer.bias, 'weighted_sq_grad', torch.mv((B**2).t(), w))
+
+        elif layer_type == 'Conv2d':
+            n = A.shape[0]
+            A = torch.nn.functional.unfold(A, layer.kernel_size)
+            B = B.reshape(n, -1, A.shape[-1])
+            grad1 = torch.einsum('ijk,ilk->ijl', B, A)
+            setattr(layer.weight, 'weighted_sq_grad', torch.einsum('i,ijl->jl', w, grad1**2)
+                    .reshape(layer.weight.shape))
+            if layer.bias is not None:
+                setattr(layer.bias, 'weighted_sq_grad', torch.einsum('i,ij->j', w, torch.sum(B, dim=2)**2))
+
+
+def compute_jvp(model: nn.Module, v: List[torch.Tensor], loss_type: str = 'mean') -> torch.Tensor:
+    """
+    Compute the per-example directional derivatives O v, i.e. sum over the parameters of
+    <grad1[n], v>, from the activations and backprops without forming grad1. Must be called after
+    loss.backprop().
+
+    Args:
+        model:
+        v: one tensor per parameter, in the order of model.parameters() and shaped like it
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+
+    Returns:
+        per-example products, shaped [n]
+    """
+
+    assert loss_type in ('sum', 'mean')
+    v_of = {id(param): v_param for param, v_param in zip(model.parameters(), v)}
+    out = 0
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_backprops(layer, loss_type)
+        V = v_of[id(layer.weight)].to(B.dtype)
+
+        if layer_type == 'Linear' or layer_type == 'MaskedLinear':
+            if layer_type == 'MaskedLinear':
+                V = V * layer.mask
+            out = out + torch.sum(torch.mm(A, V.t()) * B, 1)
+            if layer.bias is not None:
+                out = out + torch.mv(B, v_of[id(layer.bias)].to(B.dtype))
+
+        elif layer_type == 'Conv2d':
+            n = A.shape[0]
+            A = torch.nn.functional.unfold(A, layer.kernel_size)
+            B = B.reshape(n, -1, A.shape[-1])
+            out = out + torch.einsum('ijk,jl,ilk->i', B, V.reshape(V.shape[0], -1), A)
+            if layer.bias is not None:
+                out = out + torch.mv(torch.sum(B, dim=2), v_of[id(layer.bias)].to(B.dtype))
+
+    return out
+
+
+def compute_vjp(model: nn.Module, u: torch.Tensor, loss_type: str = 'mean') -> List[torch.Tensor]:
+    """
+    Compute O^T u = sum_n u[n]*grad1[n] for every parameter, the transpose of compute_jvp, through
+    compute_weighted_grad (one matmul per layer, grad1 is never formed).
+
+    Args:
+        model:
+        u: per-example weights, shaped [n]
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+
+    Returns:
+        one tensor per parameter, in the order of model.parameters()
+    """
+
+    compute_weighted_grad(model, u, loss_type)
+    return [param.weighted_grad for param in model.parameters()]
+
+
+def compute_kfac_factors(model: nn.Module, weights: torch.Tensor, loss_type: str = 'mean') -> None:
+    """
+    Compute the Kronecker factors of the weighted second moment of the per-example gradients and save
+    them under 'layer.kfac_A' (mean of a a^T, with a 1 appended to a when the layer has a bias) and
+    'layer.kfac_B' (mean of weights[n]*b b^T), so that mean_n weights[n]*vec(grad1[n]) vec(grad1[n])^T
+    over the weight and bias of a layer is approximated by kfac_A (x) kfac_B. For Conv2d the outer
+    products are summed over the output positions. Must be called after loss.backprop().
+
+    Args:
+        model:
+        weights: per-example weights, shaped [n]
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+    """
+
+    assert loss_type in ('sum', 'mean')
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_backprops(layer, loss_type)
+        n = A.shape[0]
+        w = weights.to(B.dtype)
+
+        if layer_type == 'Linear' or layer_type == 'MaskedLinear':
+            if layer.bias is not None:
+                A = torch.cat((A, torch.ones([n, 1], dtype=A.dtype)), 1)
+            setattr(layer, 'kfac_A', torch.mm(A.t(), A) / n)
+            setattr(layer, 'kfac_B', torch.mm((w[:, None] * B).t(), B) / n)
+
+        elif layer_type == 'Conv2d':
+            A = torch.nn.functional.unfold(A, layer.kernel_size)
+            B = B.reshape(n, -1, A.shape[-1])
+            if layer.bias is not None:
+                A = torch.cat((A, torch.ones([n, 1, A.shape[-1]], dtype=A.dtype)), 1)
+            setattr(layer, 'kfac_A', torch.einsum('ijk,ilk->jl', A, A) / n)
+            setattr(layer, 'kfac_B', torch.einsum('i,ijk,ilk->jl', w, B, B) / n)
+
+
+def _activations_backprops(layer: nn.Module, loss_type: str):
+    """The activations A and the per-example backprops B captured at layer"""
+
+    assert hasattr(layer, 'activations'), "No activations detected, run forward after add_hooks(model)"
+    assert hasattr(layer, 'backprops_list'), "No backprops detected, run backward after add_hooks(model)"
+    assert len(layer.backprops_list) == 1, "Multiple backprops detected, make sure to call clear_backprops(model)"
+
+    A = layer.activations
+    n = A.shape[0]
+    if loss_type == 'mean':
+        B = layer.backprops_list[0] * n
+    else:  # loss_type == 'sum':
+        B = layer.backprops_list[0]
+
+    return A, B
+
+
 def compute_hess(model: nn.Module,) -> None:
     """Save Hessian under param.hess for each param in the model"""
 